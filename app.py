@@ -1,14 +1,43 @@
-from dash import Dash, html
-import dash_bootstrap_components as dbc
-import dash
+from __future__ import annotations
+
+import contextlib
 import logging
 import argparse
-from util import LogLevel, EnumAction
-from pages.internal.web.schema import CACHE
+import json
+import sys
+from typing import TYPE_CHECKING, Optional
+from util import LogLevel, EnumAction, ImportTimer
+from pages.internal.web.cache import RequestKind
+from datetime import timedelta
+from pathlib import Path
 import os
 
-def run() -> None:
-    """A function which starts the web app."""
+DEFAULT_BOOKMARKS = Path(__file__).resolve().parent / "bookmarks.txt"
+
+# Dash, the pages and the scraper are imported on demand, so commands which
+# do not serve the UI start quickly
+if TYPE_CHECKING:
+    from dash import Dash
+
+
+def create_app(thumb_cache_size: Optional[int] = None) -> Dash:
+    """
+    Build the web app and its Flask routes
+
+    Args:
+        thumb_cache_size (Optional[int]): Megabytes of thumbnails kept on disk
+
+    Returns:
+        Dash: The app, its Flask server is ``app.server``
+    """
+    from dash import Dash, html
+    import dash_bootstrap_components as dbc
+    import dash
+    from flask import jsonify
+    from pages.internal.web.ingest import WORKER
+    from pages.internal.web import interfaces as inter
+    from pages.internal.web import serving
+    from pages.internal.web import thumbs
 
     app = Dash(
         __name__,
@@ -20,10 +49,115 @@ def run() -> None:
 
     # The app.layout components contains what is displayed by the web app
     app.layout = html.Div([dash.page_container])
+
+    # Progress of background ingestion, polled by the UI
+    app.server.add_url_rule(
+        '/api/ingest', 'ingest_status', lambda: jsonify(WORKER.status())
+    )
+    # Every request gets its own database sessions
+    app.server.teardown_appcontext(lambda exc: inter.DBMi.remove())
+
+    # Small local copies of the card images
+    if thumb_cache_size is not None:
+        thumbs.THUMBS.max_bytes = thumb_cache_size * 1024 ** 2
+    app.server.add_url_rule(thumbs.ROUTE, 'thumbnail', thumbs.serve)
+
+    # Compressed callback JSON and long lived Dash bundles
+    serving.install(app.server)
+    return app
+
+
+def configure(args: argparse.Namespace) -> None:
+    """
+    Apply the scraper, cache and ingestion settings of the command line
+
+    Args:
+        args (argparse.Namespace): The parsed command line
+    """
+    from pages.internal.web import interfaces as inter
+    from pages.internal.web import extract
+    from pages.internal.web import ingest
+    from pages.internal.web import scraper
+
+    inter.SCHED.configure(
+        max_connections=args.max_connections,
+        per_host=args.per_host,
+        max_retries=args.max_retries,
+        max_page_bytes=args.max_page_size * 1024 if args.max_page_size else None,
+    )
+    extract.configure(args.parse_workers)
+    if args.api_base is not None:
+        scraper.configure_api(args.api_base)
+    if args.no_cache:
+        inter.SCHED.cache = None
+    else:
+        if args.cache_size is not None:
+            inter.SCHED.cache.max_bytes = args.cache_size * 1024 ** 2
+        for ttl in args.cache_ttl:
+            kind, seconds = ttl.split('=')
+            inter.SCHED.cache.ttl[RequestKind[kind]] = float(seconds)
+
+    if args.image_ttl is not None:
+        ingest.IMAGE_TTL = timedelta(days=args.image_ttl)
+
+
+def run(app: Dash) -> None:
+    """A function which starts the web app."""
     app.run_server(debug=True)
     # app.run_server()
 
 
+def serve(app: Dash, host: str, port: int, workers: int, threads: int) -> None:
+    """
+    Start the web app with a multi-worker WSGI server
+
+    Args:
+        app (Dash): The app to serve
+        host (str): The interface to listen on
+        port (int): The port to listen on
+        workers (int): The number of worker processes
+        threads (int): The number of threads per worker
+    """
+    from pages.internal.web import interfaces as inter
+    from pages.internal.web import serving
+
+    # Migrate the database once, before forking the workers
+    dbm = inter.DBMi
+    serving.serve(
+        app.server, host=host, port=port, workers=workers, threads=threads,
+        post_fork=dbm.dispose,
+    )
+
+
+def ingest(
+    path: Path, concurrency: int, dry_run: bool, interval: float, output: Optional[Path],
+    comments: bool = True,
+) -> None:
+    """
+    Sync a bookmarks file without starting the web app
+
+    Progress goes to stderr, the throughput summary is printed as JSON.
+
+    Args:
+        path (Path): The bookmarks file to sync
+        concurrency (int): The number of concurrent scraper workers
+        dry_run (bool): Scrape the new bookmarks without saving anything
+        interval (float): Seconds between live throughput reports, 0 to disable them
+        output (Optional[Path]): Where to write the JSON summary, stdout if None
+        comments (bool): Crawl the comments of the bookmarks after the sync
+    """
+    from pages.internal.web.ingest import ingest_bookmarks
+
+    # Keep stdout for the summary
+    with contextlib.redirect_stdout(sys.stderr):
+        summary = ingest_bookmarks(path, concurrency, dry_run, interval, comments)
+    text = json.dumps(summary, indent=2)
+    if output is None:
+        print(text)
+    else:
+        output.write_text(text + '\n')
+
+
 if __name__ == "__main__":
 
     # Parse args
@@ -44,12 +178,173 @@ if __name__ == "__main__":
         help='refresh the database by deleting the cache',
     )
 
+    parser.add_argument(
+        '--api-base',
+        default=None,
+        help='base url of the Hacker News api, e.g. a local stand-in',
+    )
+    parser.add_argument(
+        '--max-connections',
+        default=None,
+        type=int,
+        help='maximum number of concurrent scraper requests',
+    )
+    parser.add_argument(
+        '--per-host',
+        default=None,
+        type=int,
+        help='maximum number of concurrent scraper requests per host',
+    )
+    parser.add_argument(
+        '--max-retries',
+        default=None,
+        type=int,
+        help='number of retries for throttled (429/503) requests',
+    )
+
+    parser.add_argument(
+        '--max-page-size',
+        default=None,
+        type=int,
+        help='maximum number of KB read from each scraped page',
+    )
+    parser.add_argument(
+        '--parse-workers',
+        default=None,
+        type=int,
+        help='number of processes parsing scraped pages (default: one per core)',
+    )
+
+    parser.add_argument(
+        '--image-ttl',
+        default=None,
+        type=float,
+        help='days before a checked image is checked again',
+    )
+    parser.add_argument(
+        '--thumb-cache-size',
+        default=None,
+        type=int,
+        help='maximum size of the thumbnail cache in MB',
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        default=False,
+        action='store_true',
+        help='disable the on-disk http response cache',
+    )
+    parser.add_argument(
+        '--cache-size',
+        default=None,
+        type=int,
+        help='maximum size of the http response cache in MB',
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        default=[],
+        action='append',
+        metavar='KIND=SECONDS',
+        help=f'cache ttl for a request kind {list(e.name for e in RequestKind)}',
+    )
+
+    parser.add_argument(
+        '--import-time',
+        default=False,
+        action='store_true',
+        help='report the startup time and the slowest imports',
+    )
+
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='run with a production WSGI server instead of the debug server',
+    )
+    serve_parser.add_argument('--host', default='127.0.0.1', help='interface to listen on')
+    serve_parser.add_argument('--port', default=8050, type=int, help='port to listen on')
+    serve_parser.add_argument(
+        '-w', '--workers',
+        default=2,
+        type=int,
+        help='number of worker processes, only one of them ingests at a time',
+    )
+    serve_parser.add_argument(
+        '-t', '--threads',
+        default=8,
+        type=int,
+        help='number of threads per worker',
+    )
+
+    ingest_parser = subparsers.add_parser(
+        'ingest',
+        help='sync a bookmarks file without the web app and report its throughput',
+    )
+    ingest_parser.add_argument(
+        'path',
+        nargs='?',
+        default=DEFAULT_BOOKMARKS,
+        type=Path,
+        help='bookmarks file exported from Harmonic',
+    )
+    ingest_parser.add_argument(
+        '-c', '--concurrency',
+        default=32,
+        type=int,
+        help='number of concurrent scraper workers',
+    )
+    ingest_parser.add_argument(
+        '-n', '--dry-run',
+        default=False,
+        action='store_true',
+        help='scrape the new bookmarks without saving anything',
+    )
+    ingest_parser.add_argument(
+        '--no-comments',
+        dest='comments',
+        default=True,
+        action='store_false',
+        help='skip crawling the comments of the bookmarks after the sync',
+    )
+    ingest_parser.add_argument(
+        '--interval',
+        default=2.,
+        type=float,
+        help='seconds between live throughput reports, 0 to disable them',
+    )
+    ingest_parser.add_argument(
+        '--json',
+        default=None,
+        type=Path,
+        help='write the throughput summary to this file instead of stdout',
+    )
+
     args = parser.parse_args()
 
+    timer = None
+    if args.import_time:
+        timer = ImportTimer()
+        timer.start()
+
     if args.refresh:
-        os.remove(CACHE[10:])
+        from pages.internal.web.schema import CACHE
+
+        # The WAL and shared memory files belong to the deleted database
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(CACHE[10:] + suffix):
+                os.remove(CACHE[10:] + suffix)
         args.refresh = False
 
     logging.basicConfig(level=args.log.value)
 
-    run()
+    configure(args)
+    app = None if args.command == 'ingest' else create_app(args.thumb_cache_size)
+    if timer is not None:
+        timer.stop()
+        print(timer.report(), file=sys.stderr)
+
+    if args.command == 'ingest':
+        ingest(args.path, args.concurrency, args.dry_run, args.interval, args.json, args.comments)
+    elif args.command == 'serve':
+        serve(app, args.host, args.port, args.workers, args.threads)
+    else:
+        run(app)
@@ -0,0 +1,281 @@
+"""
+Local stand-in for the Hacker News api, the article hosts, the image host
+and Bing image search, for benchmarking the scrapers offline.
+
+Every host is a threaded HTTP server on its own port of 127.0.0.1, so the
+scheduler sees them as separate hosts. Latency, errors, payload sizes and
+rate limits are set with a ``FakeConfig``.
+
+Run standalone with ``python -m benchmarks.fake_server``, then point the app
+at it with ``--api-base``.
+"""
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import threading
+import random
+import json
+import time
+import zlib
+import re
+
+ITEM = re.compile(r'^/v0/item/(\d+)\.json$')
+ARTICLE = re.compile(r'^/articles/(\d+)$')
+IMAGE = re.compile(r'^/images/(\d+)\.png$')
+
+# Items are stories with comments, every tenth one an Ask HN without a url
+ASK_EVERY = 10
+KIDS = 3
+
+
+@dataclass
+class FakeConfig:
+    """
+    Behaviour of the stand-in hosts
+
+    Args:
+        latency (float): Mean seconds before each response
+        jitter (float): Latency varies uniformly by this many seconds either way
+        error_rate (float): Fraction of requests answered with a 500
+        page_bytes (int): Size of each article
+        image_bytes (int): Size of each image
+        rate_limit (Optional[float]): Requests per second per host before answering 429
+        hosts (int): Number of article hosts
+        seed (int): Seed of the latency and error draws
+    """
+    latency: float = .02
+    jitter: float = .01
+    error_rate: float = 0.
+    page_bytes: int = 64 * 1024
+    image_bytes: int = 16 * 1024
+    rate_limit: Optional[float] = None
+    hosts: int = 16
+    seed: int = 0
+
+
+class TokenBucket:
+    """Allows ``rate`` requests per second with bursts of up to one second's worth"""
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+Route = Callable[[str, Dict[str, List[str]]], Optional[Tuple[str, bytes]]]
+
+
+class FakeHost(ThreadingHTTPServer):
+    """One host of the stand-in, answering GET and HEAD through ``route``"""
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, config: FakeConfig, route: Route) -> None:
+        super().__init__(('127.0.0.1', 0), FakeHandler)
+        self.config = config
+        self.route = route
+        self.bucket = TokenBucket(config.rate_limit) if config.rate_limit else None
+        self.random = random.Random(config.seed + self.server_address[1])
+        self._lock = threading.Lock()
+
+    @property
+    def base(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def draw(self) -> Tuple[float, bool]:
+        """The latency of a request and whether it fails"""
+        with self._lock:
+            jitter = self.random.uniform(-self.config.jitter, self.config.jitter)
+            failed = self.random.random() < self.config.error_rate
+        return max(0., self.config.latency + jitter), failed
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as the scraper's session pools its connections
+    protocol_version = 'HTTP/1.1'
+    server: FakeHost
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, body: bool):
+        latency, failed = self.server.draw()
+        time.sleep(latency)
+        if self.server.bucket is not None and not self.server.bucket.take():
+            self.send(429, 'text/plain', b'Too Many Requests', body, {'Retry-After': '1'})
+            return
+        if failed:
+            self.send(500, 'text/plain', b'Internal Server Error', body)
+            return
+        parts = urlsplit(self.path)
+        found = self.server.route(parts.path, parse_qs(parts.query))
+        if found is None:
+            self.send(404, 'text/plain', b'Not Found', body)
+        else:
+            self.send(200, *found, body)
+
+    def send(
+        self, status: int, content_type: str, content: bytes, body: bool,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+
+class FakeHN:
+    """
+    The api, article, image and search hosts, serving from background threads
+
+    Args:
+        config (FakeConfig): Behaviour of the hosts
+    """
+    def __init__(self, config: Optional[FakeConfig] = None) -> None:
+        self.config = config or FakeConfig()
+        self.api = FakeHost(self.config, self.api_route)
+        self.articles = [FakeHost(self.config, self.article_route) for _ in range(self.config.hosts)]
+        self.images = FakeHost(self.config, self.image_route)
+        self.search = FakeHost(self.config, self.search_route)
+        self.hosts = [self.api, self.images, self.search] + self.articles
+        self.maxitem = 0
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def api_base(self) -> str:
+        return f'{self.api.base}/v0'
+
+    @property
+    def search_url(self) -> str:
+        """The Bing image search url template of ``BingImgSearch``"""
+        return f'{self.search.base}/images/search?q={{q}}&first=1'
+
+    def article_url(self, item_id: int) -> str:
+        return f'{self.articles[item_id % len(self.articles)].base}/articles/{item_id}'
+
+    def image_url(self, item_id: int) -> str:
+        return f'{self.images.base}/images/{item_id}.png'
+
+    def api_route(self, path: str, query: Dict[str, List[str]]) -> Optional[Tuple[str, bytes]]:
+        if path == '/v0/maxitem.json':
+            return 'application/json', json.dumps(self.maxitem).encode()
+        if path == '/v0/updates.json':
+            return 'application/json', json.dumps({'items': [], 'profiles': []}).encode()
+        match = ITEM.match(path)
+        if match is None:
+            return None
+        item_id = int(match.group(1))
+        self.maxitem = max(self.maxitem, item_id)
+        item = {
+            'id': item_id,
+            'by': f'user{item_id % 997}',
+            'time': 1_600_000_000 + item_id,
+            'title': f'Story {item_id}',
+            'type': 'story',
+            'score': item_id % 500,
+            'descendants': KIDS,
+            'kids': [item_id * 10 + x for x in range(1, KIDS + 1)],
+        }
+        if item_id % ASK_EVERY == 0:
+            item['text'] = f'<p>Ask HN {item_id}</p>'
+        else:
+            item['url'] = self.article_url(item_id)
+        return 'application/json', json.dumps(item).encode()
+
+    def article_route(self, path: str, query: Dict[str, List[str]]) -> Optional[Tuple[str, bytes]]:
+        match = ARTICLE.match(path)
+        if match is None:
+            return None
+        item_id = int(match.group(1))
+        head = (
+            f'<!doctype html><html><head><title>Story {item_id}</title>'
+            f'<meta name="description" content="Article {item_id}">'
+            f'<meta property="og:image" content="{self.image_url(item_id)}">'
+            '</head><body>'
+        ).encode()
+        paragraph = f'<p>Paragraph of article {item_id}, with some words to index.</p>'.encode()
+        n = max(0, self.config.page_bytes - len(head)) // len(paragraph) + 1
+        return 'text/html; charset=utf-8', head + paragraph * n + b'</body></html>'
+
+    def image_route(self, path: str, query: Dict[str, List[str]]) -> Optional[Tuple[str, bytes]]:
+        if IMAGE.match(path) is None:
+            return None
+        return 'image/png', b'\x89PNG\r\n\x1a\n' + b'\0' * self.config.image_bytes
+
+    def search_route(self, path: str, query: Dict[str, List[str]]) -> Optional[Tuple[str, bytes]]:
+        if path != '/images/search':
+            return None
+        q = query.get('q', [''])[0]
+        url = self.image_url(zlib.crc32(q.encode()) % 1_000_000)
+        return 'text/html', f'<a m="{{murl&quot;:&quot;{url}&quot;}}">{q}</a>'.encode()
+
+    def start(self) -> 'FakeHN':
+        for host in self.hosts:
+            thread = threading.Thread(target=host.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        for host in self.hosts:
+            host.shutdown()
+            host.server_close()
+
+    def __enter__(self) -> 'FakeHN':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def serve(config: FakeConfig, conn):
+    """Run the stand-in in a child process, sending back its urls over ``conn``"""
+    with FakeHN(config) as fake:
+        conn.send({'api_base': fake.api_base, 'search_url': fake.search_url})
+        # Serve until the parent asks to stop
+        conn.recv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    defaults = FakeConfig()
+    for key, value in asdict(defaults).items():
+        parser.add_argument(
+            f"--{key.replace('_', '-')}",
+            default=value,
+            type=type(value) if value is not None else float,
+        )
+    config = FakeConfig(**vars(parser.parse_args()))
+    with FakeHN(config) as fake:
+        print(f'api: {fake.api_base}')
+        print(f'search: {fake.search_url}')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
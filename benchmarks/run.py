@@ -0,0 +1,273 @@
+"""
+Offline benchmarks of the scrapers against the local stand-in hosts.
+
+For every N, a fresh database is filled from a bookmarks file of N posts by
+the headless ingestion, the images of the new posts are validated and N Bing
+image searches are made. Each suite runs in its own process, so the peak
+memory is its own, and reports its throughput, the p50/p99 latency of its
+requests and its peak resident memory.
+
+    python -m benchmarks.run --sizes 1000 10000 100000 --output results.json
+"""
+from collections import defaultdict
+from dataclasses import asdict, fields
+from functools import partial
+from pathlib import Path
+from urllib.parse import urlsplit
+from typing import Any, Dict, List, Optional
+import multiprocessing
+import contextlib
+import subprocess
+import tempfile
+import argparse
+import platform
+import logging
+import json
+import time
+import sys
+import os
+
+from benchmarks.fake_server import FakeConfig, serve
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SUITES = ('ingest', 'images', 'bing')
+SIZES = (1_000, 10_000, 100_000)
+
+
+def request_kind(url: str) -> str:
+    """The kind of stand-in host a url is for"""
+    if '/v0/' in url:
+        return 'item'
+    if '/articles/' in url:
+        return 'article'
+    if '/images/search' in url:
+        return 'bing'
+    return 'image'
+
+
+def percentile(values: List[float], q: float) -> float:
+    """The nearest rank percentile of sorted values"""
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+class LatencyRecorder:
+    """
+    Wraps the scraper's http session, timing every request up to its headers
+
+    Args:
+        session: The ``asks.Session`` to wrap
+    """
+    def __init__(self, session) -> None:
+        self.session = session
+        self.times: Dict[str, List[float]] = defaultdict(list)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.session, attr)
+
+    async def request(self, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.session.request(method, url, **kwargs)
+        finally:
+            self.times[request_kind(url)].append(time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        output = {}
+        for kind, times in sorted(self.times.items()):
+            times = sorted(times)
+            output[kind] = {
+                'requests': len(times),
+                'p50_ms': round(percentile(times, 50) * 1000, 2),
+                'p99_ms': round(percentile(times, 99) * 1000, 2),
+            }
+        return output
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process and of its reaped children"""
+    if resource is None:
+        return None
+    # Kilobytes on Linux, bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return round(peak / scale, 1)
+
+
+def run_suite(suite: str, n: int, workdir: str, urls: Dict[str, str], options: Dict[str, Any], conn):
+    """
+    Run one suite against the stand-in, in a process of its own
+
+    The database and api are set through the environment before the app
+    modules are first imported.
+    """
+    os.environ['HN_BROWSER_DB'] = str(Path(workdir) / 'hackernews.db')
+    os.environ['HN_API_BASE'] = urls['api_base']
+    logging.basicConfig(level=logging.WARNING)
+
+    from pages.internal.web import interfaces as inter
+    from pages.internal.web import extract
+    from pages.internal.web import ingest
+    from pages.internal.web import scraper
+    from pages.internal.web.client import DEFAULT_HOST_LIMITS
+    from pages.internal.web.schema import Post
+    from sqlalchemy import select
+    import trio
+
+    # Every run starts cold
+    inter.SCHED.cache = None
+    inter.SCHED.configure(
+        max_connections=options['max_connections'], per_host=options['per_host']
+    )
+    # The stand-in api gets the same allowance as the real one
+    inter.SCHED.host_limits[urlsplit(urls['api_base']).netloc] = (
+        DEFAULT_HOST_LIMITS['hacker-news.firebaseio.com']
+    )
+    extract.configure(options['parse_workers'])
+    recorder = LatencyRecorder(inter.SESS)
+    inter.SESS = recorder
+    workers = options['concurrency']
+
+    output: Dict[str, Any] = {'suite': suite, 'n': n}
+    start = time.perf_counter()
+    # The scrapers print their progress
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if suite == 'ingest':
+            path = Path(workdir) / 'bookmarks.txt'
+            path.write_text('-'.join(f'{x}q{1_600_000_000_000 + x}' for x in range(1, n + 1)))
+            summary = ingest.ingest_bookmarks(path, workers=workers, interval=0, comments=False)
+            items, errors = n, n - summary['scraped']
+            output['stages'] = summary['stages']
+        elif suite == 'images':
+            images = [
+                tuple(x) for x in inter.DBMi.session.execute(
+                    select(Post.id, Post.img).where(Post.img.is_not(None))
+                )
+            ]
+            counts = trio.run(partial(scraper.validate_images, images, workers=workers))
+            items = sum(counts.values())
+            errors = counts.get(scraper.ImageStatus.error, 0)
+        elif suite == 'bing':
+            search = scraper.BingImgSearch()
+            search.base_url = urls['search_url']
+            for x in range(1, n + 1):
+                search.add_query(f'Story {x}')
+            found = search.get_urls()
+            items, errors = n, sum(x is None for x in found)
+        else:
+            raise ValueError(f'Unknown suite {suite}')
+    seconds = time.perf_counter() - start
+
+    # Reap the parse processes so their memory is counted
+    if extract._POOL is not None:
+        extract._POOL.shutdown()
+    output.update({
+        'seconds': round(seconds, 3),
+        'items': items,
+        'errors': errors,
+        'items_per_s': round(items / seconds, 2) if seconds else 0.,
+        'error_rate': round(errors / items, 4) if items else 0.,
+        'latency': recorder.summary(),
+        'peak_rss_mb': peak_rss_mb(),
+    })
+    conn.send(output)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True, cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(SIZES), help='numbers of bookmarks')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES), help='suites to run')
+    parser.add_argument('--concurrency', default=32, type=int, help='number of concurrent scraper workers')
+    parser.add_argument('--max-connections', default=64, type=int, help='maximum number of concurrent requests')
+    parser.add_argument('--per-host', default=8, type=int, help='maximum number of concurrent requests per host')
+    parser.add_argument('--parse-workers', default=None, type=int, help='number of parse processes')
+    parser.add_argument('--output', default=None, type=Path, help='write the results as JSON to this file')
+    # The stand-in's behaviour
+    for field in fields(FakeConfig):
+        default = getattr(FakeConfig, field.name)
+        parser.add_argument(
+            f"--{field.name.replace('_', '-')}",
+            default=default,
+            type=type(default) if default is not None else float,
+            help=f'stand-in {field.name.replace("_", " ")}',
+        )
+    args = parser.parse_args()
+    config = FakeConfig(**{x.name: getattr(args, x.name) for x in fields(FakeConfig)})
+    options = {
+        'concurrency': args.concurrency,
+        'max_connections': args.max_connections,
+        'per_host': args.per_host,
+        'parse_workers': args.parse_workers,
+    }
+
+    # Forking a process which imported trio is unsafe
+    ctx = multiprocessing.get_context('spawn')
+    server_conn, child_conn = ctx.Pipe()
+    server = ctx.Process(target=serve, args=(config, child_conn), daemon=True)
+    server.start()
+    urls = server_conn.recv()
+
+    results = []
+    try:
+        for n in args.sizes:
+            # Every size gets a fresh database, shared by its suites in order
+            with tempfile.TemporaryDirectory(prefix=f'hn-bench-{n}-') as workdir:
+                for suite in args.suites:
+                    recv, send = ctx.Pipe(duplex=False)
+                    proc = ctx.Process(target=run_suite, args=(suite, n, workdir, urls, options, send))
+                    proc.start()
+                    try:
+                        result = recv.recv()
+                    except EOFError:
+                        result = None
+                    proc.join()
+                    if proc.exitcode != 0 or result is None:
+                        raise RuntimeError(f'{suite} with {n} bookmarks failed')
+                    results.append(result)
+                    latency = ', '.join(
+                        f"{kind} p50 {x['p50_ms']}ms p99 {x['p99_ms']}ms"
+                        for kind, x in result['latency'].items()
+                    )
+                    print(
+                        f"{suite:>7} {n:>7}: {result['items_per_s']:>8.1f} items/s, "
+                        f"{result['error_rate']:.1%} errors, {result['peak_rss_mb']} MB peak, {latency}",
+                        flush=True,
+                    )
+    finally:
+        server_conn.send('stop')
+        server.join(timeout=5)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': asdict(config),
+        'options': options,
+        'results': results,
+    }
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2) + '\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,20 @@ from .internal.web.scraper import MultiScraper
 from .css import *
 from .internal.web import interfaces as inter
 from .internal.web.schema import Post
+from .internal.web.tables import TableQuery
+from .internal.web import stats
+from sqlalchemy import func, select
 import plotly.graph_objects as go
 
 
 dash.register_page(__name__, path="/dash")
 
+MISSING_HTML_TABLE = TableQuery(
+    {'title': Post.title, 'url': Post.url},
+    where=[Post.url.isnot(None), ~Post.body.has()],
+    key=Post.id,
+)
+
 
 # @callback(
 #     Output('home-page', 'children'), 
@@ -29,32 +38,29 @@ def plot_url_stats(min_count: int = 0, show_column: str = "posts"):
         min_count (int): Minimum number of posts to include in plot
         show_column (str): Which column to display ('posts' or 'comments')
     """
-    # Get all posts with URLs
-    posts = inter.DBMi.session.query(Post).filter(Post.url.isnot(None)).all()
-    
-    # Extract domains and count frequencies
-    from urllib.parse import urlparse
-    domain_stats = {}
-    for post in posts:
-        try:
-            domain = urlparse(post.url).netloc.split('.')[-2]
-            if domain not in domain_stats:
-                domain_stats[domain] = {
-                    'posts': 0,
-                    'children': 0
-                }
-            domain_stats[domain]['posts'] += 1
-            domain_stats[domain]['children'] += post.descendants
-        except:
-            continue
-    
-    # Filter based on minimum count
-    domain_stats = {k:v for k,v in domain_stats.items() if v['posts'] >= min_count}
-            
+    return dcc.Graph(figure=url_stats_figure(min_count, show_column))
+
+@stats.memoize
+def url_stats_figure(min_count: int, show_column: str) -> go.Figure:
+    # Aggregate the posts and comments per domain in SQL
+    n_posts = func.count(Post.id)
+    rows = (
+        inter.DBMi.reader.query(
+            Post.domain,
+            n_posts,
+            func.coalesce(func.sum(Post.descendants), 0)
+        )
+        .filter(Post.domain.isnot(None))
+        .group_by(Post.domain)
+        .having(n_posts >= min_count)
+        .order_by(n_posts.desc(), Post.domain)
+        .all()
+    )
+
     # Convert to lists for plotting
-    domains = list(domain_stats.keys())
-    values = [stats['posts'] if show_column == "posts" else stats['children'] 
-             for stats in domain_stats.values()]
+    domains = [domain for domain, _, _ in rows]
+    values = [posts if show_column == "posts" else children
+             for _, posts, children in rows]
 
     # Create bar plot
     fig = go.Figure(data=[
@@ -72,7 +78,7 @@ def plot_url_stats(min_count: int = 0, show_column: str = "posts"):
         height=400
     )
 
-    return dcc.Graph(figure=fig)
+    return fig
 
 def plot_date_histogram(bin_size: int = 7):
     """
@@ -81,8 +87,18 @@ def plot_date_histogram(bin_size: int = 7):
     Args:
         bin_size (int): Size of bins in days
     """
-    posts = inter.DBMi.session.query(Post).all()
-    dates = [post.date_added.date() for post in posts]
+    return dcc.Graph(figure=date_histogram_figure(bin_size))
+
+@stats.memoize
+def added_dates() -> List:
+    """The date every post was added, shared by all bin sizes"""
+    return [
+        x.date() for x in inter.DBMi.reader.scalars(select(Post.date_added))
+    ]
+
+@stats.memoize
+def date_histogram_figure(bin_size: int) -> go.Figure:
+    dates = added_dates()
     
     fig = go.Figure(data=[
         go.Histogram(
@@ -102,26 +118,31 @@ def plot_date_histogram(bin_size: int = 7):
         bargap=0.1
     )
     
-    return dcc.Graph(figure=fig)
+    return fig
+
+@stats.memoize
+def missing_counts() -> Dict[str, int]:
+    """Count the posts, and those missing an image or html"""
+    session = inter.DBMi.reader
+    return {
+        'total': stats.post_count(),
+        'img': session.query(Post).filter(Post.img.is_(None)).count(),
+        'html': session.query(Post).filter(~Post.body.has()).count(),
+    }
 
 def get_page():
     """
     Get the dashboard page
     """
     contents = []
-    missing_imgs = inter.DBMi.session.query(Post).filter(Post.img.is_(None)).count()
-    missing_imgs_perc = missing_imgs/inter.DBMi.session.query(Post).count()*100
+    counts = missing_counts()
+    total = counts['total']
+    missing_imgs = counts['img']
+    missing_imgs_perc = missing_imgs/total*100
     
-    # Get posts missing HTML
-    missing_html_posts = inter.DBMi.session.query(Post).filter(Post.html.is_(None)).all()
-    missing_html = len(missing_html_posts)
-    missing_html_perc = missing_html/inter.DBMi.session.query(Post).count()*100
-
-    # Prepare data for DataTable
-    table_data = [
-        {'title': post.title, 'url': post.url} 
-        for post in missing_html_posts if post.url is not None
-    ]
+    # Count posts missing HTML, the table itself is paged in SQL
+    missing_html = counts['html']
+    missing_html_perc = missing_html/total*100
 
     notif = html.Span([
         dbc.Badge(
@@ -178,7 +199,8 @@ def get_page():
                 dbc.Col([
                     html.H4("Posts Missing HTML", className="mt-4"),
                     dash_table.DataTable(
-                        data=table_data,
+                        id='missing-html-table',
+                        data=[],
                         columns=[
                             {'name': 'Title', 'id': 'title'},
                             {'name': 'URL', 'id': 'url'}
@@ -195,7 +217,13 @@ def get_page():
                             'backgroundColor': 'rgb(230, 230, 230)',
                             'fontWeight': 'bold'
                         },
+                        page_current=0,
                         page_size=10,
+                        page_action='custom',
+                        sort_action='custom',
+                        sort_by=[],
+                        filter_action='custom',
+                        filter_query='',
                     )
                 ])
             ]
@@ -205,6 +233,21 @@ def get_page():
     contents.append(notif)
     return dbc.Container(contents, id="dashboard")
 
+@callback(
+    [
+        Output("missing-html-table", "data"),
+        Output("missing-html-table", "page_count"),
+    ],
+    [
+        Input("missing-html-table", "page_current"),
+        Input("missing-html-table", "page_size"),
+        Input("missing-html-table", "sort_by"),
+        Input("missing-html-table", "filter_query"),
+    ],
+)
+def update_missing_html(page_current, page_size, sort_by, filter_query):
+    return MISSING_HTML_TABLE.page(page_current, page_size, sort_by, filter_query)
+
 @callback(
     Output("url-stats-plot", "children"),
     Input("min-posts-filter", "value"),
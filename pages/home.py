@@ -10,48 +10,40 @@ from dash import (
     dash_table
 )
 import dash_bootstrap_components as dbc
-from sqlalchemy import update
 import dash
-from typing import List, Dict
+from typing import List, Dict, Optional
 from datetime import datetime
-from .internal.web.scraper import (
-    MultiScraper, 
-    BingImgSearch, 
-    update_posts,
-    validate_all
-)
 from .css import *
 from .internal.web import interfaces as inter
+from .internal.web.ingest import (
+    IMAGE_CHECK,
+    WORKER,
+    submit_image_check,
+    submit_refresh,
+    submit_retries,
+    submit_sync,
+)
 from .internal.web.schema import Post
-from alive_progress import alive_bar
+from .internal.web.tables import KeysetPager, TableQuery
+from .internal.web import stats
+from .internal.web.search import search
+from .internal.web.thumbs import thumb_url
 import numpy as np
-import trio
 
 DEFAULT_BOOKMARKS = Path(__file__).resolve().parent.parent / "bookmarks.txt"
-BASE_ROUTE = "https://hacker-news.firebaseio.com/v0/item/{id}.json"
 HN_LINK = "https://www.hckrnws.com/stories/{id}"
 ROW_LEN = 6
 
-dash.register_page(__name__, path="/")
-
+# Card grid orders, keyset paginated on an indexed key
+CARD_SORTS = {
+    'added-desc': ('Recently Added', KeysetPager(Post.date_added, Post.id)),
+    'added-asc': ('First Added', KeysetPager(Post.date_added, Post.id, descending=False)),
+    'id-desc': ('Newest Posts', KeysetPager(Post.id, Post.id)),
+    'id-asc': ('Oldest Posts', KeysetPager(Post.id, Post.id, descending=False)),
+}
+DEFAULT_SORT = 'added-desc'
 
-def get_bookmarks(path: Path = DEFAULT_BOOKMARKS) -> Dict[datetime, str]:
-    with open(path) as fp:
-        bookmarks = "".join(fp.readlines())
-    bookmarks = bookmarks.split("-")
-    output = {}
-
-    print(f"Querying cached bookmarks...")
-    with alive_bar(len(bookmarks)) as bar:
-        for x in range(len(bookmarks)):
-            parsed = bookmarks[x].split("q")
-            if not inter.DBMi.session.query(Post).filter(Post.id == parsed[0]).count():
-                output[
-                    datetime.fromtimestamp(float(parsed[1]) / 1e3)
-                ] = BASE_ROUTE.format(id=parsed[0])
-            bar()
-
-    return output
+dash.register_page(__name__, path="/")
 
 
 def make_card(link: Post):
@@ -83,7 +75,7 @@ def make_card(link: Post):
                 style=OVERFLOW_TEXT
             ),
             dbc.CardImg(
-                src=link.img, 
+                src=thumb_url(link), 
                 # top=True, 
                 className="img-fluid rounded-start",
                 style=IMG_STYLE
@@ -115,17 +107,35 @@ def get_card_row(links: List[Post]):
 
 
 @callback(
-    Output("content-container", "children"),
+    [
+        Output("content-container", "children"),
+        Output("page-cursors", "data"),
+    ],
     [
         Input("view-selector", "value"),
         Input("page-num", "data"),
+        Input("card-sort", "value"),
+        Input("search-box", "value"),
+        Input("db-generation", "data"),
     ],
+    [State("page-cursors", "data")],
 )
-def update_view(view_type: list, page: int):
+def update_view(
+    view_type: list, page: int, sort: str, query: str, generation: int, cursors: dict
+):
+    if ctx.triggered_id in ("card-sort", "search-box"):
+        # The cursors are only valid for the order they were made for
+        page, cursors = 1, {}
+    if query and query.strip():
+        return get_search(query, page), cursors
     if not view_type:  # Empty list means switch is off
-        return get_native(page)
+        # New posts re-render the current page, from the cursor it was reached by
+        return get_native(page, sort, cursors)
+    elif ctx.triggered_id == "db-generation":
+        # The table loads its own pages, so keep its page and filters
+        return dash.no_update, dash.no_update
     else:
-        return get_table()
+        return get_table(), dash.no_update
 
 
 @callback(
@@ -139,38 +149,60 @@ def reload_imgs(page: int):
     return page
 
 
+@callback(
+    [
+        Output("ingest-status", "children"),
+        Output("db-generation", "data"),
+    ],
+    [Input("ingest-poll", "n_intervals")],
+    [State("db-generation", "data")],
+)
+def poll_ingest(n_intervals: int, generation: int):
+    status = WORKER.status()
+    if status['active']:
+        job = status['active'][0]
+        label = f"{job['label']} {job['progress']}/{job['total']}" if job['total'] else job['label']
+    else:
+        label = ""
+    # Only reload the content once something was written, by any process
+    current = stats.generation()
+    return label, dash.no_update if current == generation else current
+
+
 @callback(
     Output('dummy', 'children'),
     [Input('chk-img', 'n_clicks')], 
     prevent_initial_call=True
 )
 def check_images(n_click: int):
-    all_posts = inter.DBMi.session.query(Post).filter(Post.img.is_not(None)).all()
-
-    valid = trio.run(validate_all, [x.img for x in all_posts])
-    valid = np.asarray(valid)
-
-    print(f'valid: {valid.sum()}')
-    print(f'invalid: {(valid==False).sum()}')
+    # Runs on the ingest worker, progress shows up in the ingest status
+    submit_image_check()
+    return None
 
-    evict = []
-    for post, validity in zip(all_posts, valid):
-        if not validity:
-            evict.append(post.id)
 
-    stmnt = update(Post).where(Post.id.in_(evict)).values(img=None)
-    inter.DBMi.session.execute(stmnt)
-    inter.DBMi.session.commit()
+@callback(
+    Output('dummy', 'title'),
+    [Input('cancel-chk-img', 'n_clicks')], 
+    prevent_initial_call=True
+)
+def cancel_check_images(n_click: int):
+    WORKER.cancel(IMAGE_CHECK)
     return None
 
 
-def get_native(page: int):
+def get_native(page: int, sort: str = DEFAULT_SORT, cursors: Optional[dict] = None):
     n_item = ROW_LEN * 3
-    total_items = inter.DBMi.session.query(Post).count()
-    bookmarks: List[Post] = inter.DBMi.session.query(Post).limit(n_item).offset((page-1)*n_item).all()
+    total_items = stats.post_count()
+    pager = CARD_SORTS.get(sort, CARD_SORTS[DEFAULT_SORT])[1]
+    cursors = dict(cursors or {})
+    bookmarks, cursor = pager.page(
+        inter.DBMi.reader.query(Post), page, n_item, cursors.get(str(page - 1))
+    )
+    if cursor is not None:
+        cursors[str(page)] = cursor
 
     # Construct Bookmarks
-    padded_bookmarks = bookmarks + [None] * (len(bookmarks) % ROW_LEN)
+    padded_bookmarks = bookmarks + [None] * (-len(bookmarks) % ROW_LEN)
     chunked = []
     for x in range(len(padded_bookmarks) // ROW_LEN):
         row = []
@@ -192,26 +224,98 @@ def get_native(page: int):
     contents += [get_card_row(row) for row in chunked]
     contents.append(pagination)
 
-    return dbc.Container(contents)
+    return dbc.Container(contents), cursors
 
-def get_table():
-    """Get a DataTable view of all bookmarks"""
-    bookmarks: List[Post] = inter.DBMi.session.query(Post).all()
-    
+def get_search(query: str, page: int):
+    """Get a page of ranked full text search results"""
+    n_item = ROW_LEN * 3
+    results, total = search(query, page, n_item)
+
+    items = [
+        dbc.ListGroupItem(
+            [
+                html.Div(
+                    [
+                        html.A(
+                            result['title'],
+                            href=result['url'] or HN_LINK.format(id=result['id']),
+                            target="_blank",
+                            className="fw-bold",
+                        ),
+                        html.A(
+                            "HN",
+                            href=HN_LINK.format(id=result['id']),
+                            target="_blank",
+                            className="ms-2 small",
+                        ),
+                    ]
+                ),
+                dcc.Markdown(result['snippet'] or '', className="small mb-0"),
+            ]
+        ) for result in results
+    ]
+
+    pagination = dbc.Pagination(
+        id='pagination', 
+        max_value=max(1, np.ceil(total/n_item)),
+        first_last=True,
+        previous_next=True,
+        fully_expanded=False,
+        style={'justify-content':'center'},
+        active_page=page
+    )
+
+    return dbc.Container([
+        html.Div(f"{total} results", className="my-2"),
+        dbc.ListGroup(items, className="mb-3"),
+        pagination,
+    ])
+
+
+BOOKMARK_TABLE = TableQuery(
+    {
+        'title': Post.title,
+        'url': Post.url,
+        'author': Post.author,
+        'date_added': Post.date_added,
+        'score': Post.score,
+        'comments': Post.descendants,
+        'has_html': Post.body.has(),
+    },
+    key=Post.id,
+)
+
+
+@callback(
+    [
+        Output("bookmarks-table", "data"),
+        Output("bookmarks-table", "page_count"),
+    ],
+    [
+        Input("bookmarks-table", "page_current"),
+        Input("bookmarks-table", "page_size"),
+        Input("bookmarks-table", "sort_by"),
+        Input("bookmarks-table", "filter_query"),
+    ],
+)
+def update_table(page_current: int, page_size: int, sort_by: list, filter_query: str):
+    rows, page_count = BOOKMARK_TABLE.page(page_current, page_size, sort_by, filter_query)
     table_data = [
         {
-            'title': f'[{post.title}]({post.url})' if post.url else post.title,
-            'url': post.url,
-            'author': post.author,
-            'date_added': post.date_added.strftime('%Y-%m-%d'),
-            'score': post.score,
-            'comments': post.descendants,
-            'has_html': 1 if post.html is not None else 0
-        } for post in bookmarks
+            **row,
+            'title': f'[{row["title"]}]({row["url"]})' if row['url'] else row['title'],
+            'date_added': row['date_added'].strftime('%Y-%m-%d'),
+            'has_html': int(row['has_html']),
+        } for row in rows
     ]
-    
+    return table_data, page_count
+
+
+def get_table():
+    """Get a DataTable view of all bookmarks, paged, sorted and filtered in SQL"""
     return dash_table.DataTable(
-        data=table_data,
+        id='bookmarks-table',
+        data=[],
         columns=[
             {'name': 'Title', 'id': 'title', 'presentation': 'markdown'},
             {'name': 'URL', 'id': 'url'},
@@ -252,25 +356,49 @@ def get_table():
                 'color': 'white'
             }
         ],
+        page_current=0,
         page_size=20,
-        sort_action='native',
-        filter_action='native',
+        page_action='custom',
+        sort_action='custom',
+        sort_mode='multi',
+        sort_by=[],
+        filter_action='custom',
+        filter_query='',
         markdown_options={'link_target': '_blank'}  # Open links in new tab
     )
 
 def get_page(page: int):
-    # Update Database with new bookmarks
-    new_bookmarks = get_bookmarks()
-    if new_bookmarks:  # Only create scraper if there are new bookmarks
-        scraper = MultiScraper(new_bookmarks)
-        scraper.save()
-    
+    # Update Database with new bookmarks in the background. Refreshes and
+    # retries are throttled, so reloading the page does not queue more.
+    submit_sync(DEFAULT_BOOKMARKS)
+    submit_refresh()
+    submit_retries()
+
     nav = dbc.Navbar(
         [
             dbc.NavbarBrand('HN Browser', style={'margin-left':'1rem'}),
             dbc.Container(
                 [
+                    dbc.Badge(id="ingest-status", color="info", style=NAV_ITEM),
                     dbc.NavLink("Dashboard", active=True, href="/dash", style=NAV_ITEM),
+                    dbc.Input(
+                        id="search-box",
+                        type="search",
+                        placeholder="Search",
+                        debounce=True,
+                        size="sm",
+                        style={"width": "16rem", **NAV_ITEM}
+                    ),
+                    dbc.Select(
+                        id="card-sort",
+                        options=[
+                            {"label": label, "value": key}
+                            for key, (label, _) in CARD_SORTS.items()
+                        ],
+                        value=DEFAULT_SORT,
+                        size="sm",
+                        style={"width": "auto", **NAV_ITEM}
+                    ),
                     dbc.Checklist(
                         options=[
                             {"label": "Table View", "value": "table"},
@@ -283,7 +411,8 @@ def get_page(page: int):
                     dbc.DropdownMenu(
                         [
                             dbc.DropdownMenuItem("Reload Images", id='rel-img'),
-                            dbc.DropdownMenuItem("Check Images", id='chk-img')
+                            dbc.DropdownMenuItem("Check Images", id='chk-img'),
+                            dbc.DropdownMenuItem("Cancel Image Check", id='cancel-chk-img'),
                         ],
                         label="Options",
                         nav=True,
@@ -303,6 +432,9 @@ def get_page(page: int):
 
     return html.Div([
         dcc.Store(id='page-num', data=1),
+        dcc.Store(id='page-cursors', data={}),
+        dcc.Store(id='db-generation', data=stats.generation()),
+        dcc.Interval(id='ingest-poll', interval=2000),
         html.Div(id='dummy', style={'display':'none'}),
         nav,
         html.Div(id="content-container")
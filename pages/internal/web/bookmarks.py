@@ -0,0 +1,122 @@
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import select
+from .schema import BookmarkState, Post
+from . import interfaces as inter
+import hashlib
+import logging
+import os
+
+# SQLite caps the number of bound parameters per statement
+ID_CHUNK = 500
+
+
+def parse_bookmarks(raw: str) -> List[Tuple[int, datetime]]:
+    """
+    Parse a Harmonic bookmarks export
+
+    The export is a single line of ``<id>q<epoch ms>`` records joined by ``-``.
+
+    Args:
+        raw (str): The (partial) contents of the export
+
+    Returns:
+        List[Tuple[int, datetime]]: The post ids and the time they were bookmarked
+    """
+    output = []
+    for record in raw.strip().strip("-").split("-"):
+        parsed = record.strip().split("q")
+        if len(parsed) != 2:
+            if record.strip():
+                logging.warning(f"Skipping malformed bookmark {record!r}")
+            continue
+        try:
+            output.append(
+                (int(parsed[0]), datetime.fromtimestamp(float(parsed[1]) / 1e3))
+            )
+        except ValueError:
+            logging.warning(f"Skipping malformed bookmark {record!r}")
+    return output
+
+
+class BookmarkDiff:
+    """
+    Diff a bookmarks file against the posts already in the database.
+
+    The size, mtime and a digest of the last synced file are kept in
+    ``bookmark_state``. An unchanged file is detected from a single ``stat``,
+    and a file that was only appended to is diffed by parsing the new tail.
+    Anything else falls back to a full parse checked against the known ids
+    in a single query.
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = Path(path).resolve()
+        self._pending: Optional[BookmarkState] = None
+
+    def _known_ids(self, ids: List[int], full: bool) -> set:
+        session = inter.DBMi.session
+        if full:
+            return set(session.scalars(select(Post.id)))
+        known = set()
+        for x in range(0, len(ids), ID_CHUNK):
+            chunk = ids[x:x + ID_CHUNK]
+            known.update(session.scalars(select(Post.id).where(Post.id.in_(chunk))))
+        return known
+
+    def new_bookmarks(self) -> List[Tuple[int, datetime]]:
+        """
+        Get the bookmarks which are not yet in the database
+
+        Returns:
+            List[Tuple[int, datetime]]: The new post ids and the time they were bookmarked
+        """
+        stat = os.stat(self.path)
+        state = inter.DBMi.session.get(BookmarkState, str(self.path))
+        if (
+            state is not None
+            and state.size == stat.st_size
+            and state.mtime_ns == stat.st_mtime_ns
+        ):
+            logging.debug(f"{self.path} unchanged since last sync")
+            return []
+
+        with open(self.path, "rb") as fp:
+            data = fp.read()
+
+        full = True
+        start = 0
+        if state is not None and len(data) >= state.offset:
+            prefix = hashlib.sha1(data[:state.offset]).hexdigest()
+            if prefix == state.digest:
+                full = False
+                start = state.offset
+
+        records = parse_bookmarks(data[start:].decode("utf-8", errors="ignore"))
+        known = self._known_ids([x[0] for x in records], full)
+        output = [x for x in records if x[0] not in known]
+
+        logging.info(
+            "Diffed {} {} bookmarks, {} new".format(
+                len(records), "total" if full else "appended", len(output)
+            )
+        )
+
+        self._pending = BookmarkState(
+            path=str(self.path),
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            offset=len(data),
+            digest=hashlib.sha1(data).hexdigest(),
+        )
+        return output
+
+    def mark_synced(self):
+        """
+        Record the diffed file as synced so the next diff only reads what changed
+        """
+        if self._pending is None:
+            return
+        inter.DBMi.session.merge(self._pending)
+        inter.DBMi.session.commit()
+        self._pending = None
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from appdirs import user_cache_dir
+from pathlib import Path
+from enum import Enum
+import threading
+import hashlib
+import logging
+import json
+import time
+import os
+
+CACHE_DIR = Path(user_cache_dir('hn-browser')) / 'http'
+
+
+class RequestKind(Enum):
+    """
+    Kinds of cached requests, each with their own TTL
+    """
+    item = 'item'
+    article = 'article'
+    bing = 'bing'
+    image = 'image'
+
+
+DEFAULT_TTL = {
+    RequestKind.item: 60 * 60,
+    RequestKind.article: 7 * 24 * 60 * 60,
+    RequestKind.bing: 30 * 24 * 60 * 60,
+    RequestKind.image: 24 * 60 * 60,
+}
+
+
+@dataclass
+class CachedResponse:
+    """
+    A response read back from the cache, quacking like ``asks`` responses
+    """
+    url: str
+    status_code: int
+    reason_phrase: str
+    headers: Dict[str, str]
+    content: bytes = field(repr=False)
+    stored: float = 0.
+
+    @property
+    def validators(self) -> Dict[str, str]:
+        """The conditional request headers for revalidating this response"""
+        output = {}
+        if 'etag' in self.headers:
+            output['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            output['If-Modified-Since'] = self.headers['last-modified']
+        return output
+
+
+class ResponseCache:
+    """
+    On-disk HTTP response cache.
+
+    Entries are stored as a json metadata file and a body file named by the
+    sha256 of the request method and url. Entries are keyed by request, not
+    by content, so the same body at two urls is stored twice. Stale entries
+    holding an ETag or Last-Modified header are revalidated with a
+    conditional request instead of being downloaded again. The least
+    recently used entries are evicted once the cache grows past
+    ``max_bytes``.
+
+    Every method does blocking file I/O, so async callers run them with
+    ``trio.to_thread.run_sync``.
+    """
+    def __init__(
+        self,
+        root: Path = CACHE_DIR,
+        ttl: Optional[Dict[RequestKind, float]] = None,
+        max_bytes: int = 1024 ** 3,
+    ) -> None:
+        self.root = Path(root)
+        self.ttl = dict(DEFAULT_TTL)
+        self.ttl.update(ttl or {})
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _paths(self, method: str, url: str):
+        key = hashlib.sha256(f'{method.upper()} {url}'.encode()).hexdigest()
+        folder = self.root / key[:2]
+        return folder / f'{key}.json', folder / f'{key}.body'
+
+    def get(self, method: str, url: str) -> Optional[CachedResponse]:
+        """
+        Get a cached response, fresh or not
+
+        Args:
+            method (str): The HTTP method of the request
+            url (str): The url of the request
+        """
+        meta_path, body_path = self._paths(method, url)
+        try:
+            with open(meta_path) as fp:
+                meta = json.load(fp)
+            with open(body_path, 'rb') as fp:
+                content = fp.read()
+            # Access time drives the LRU eviction
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            return None
+        return CachedResponse(content=content, **meta)
+
+    def fresh(self, entry: CachedResponse, kind: RequestKind) -> bool:
+        return time.time() - entry.stored < self.ttl[kind]
+
+    def put(self, method: str, url: str, resp) -> CachedResponse:
+        """
+        Store a response
+
+        Args:
+            method (str): The HTTP method of the request
+            url (str): The url of the request
+            resp: The ``asks`` or cached response to store
+        """
+        entry = CachedResponse(
+            url=url,
+            status_code=resp.status_code,
+            reason_phrase=resp.reason_phrase,
+            headers={k.lower(): v for k, v in dict(resp.headers).items()},
+            content=resp.content or b'',
+            stored=time.time(),
+        )
+        meta_path, body_path = self._paths(method, url)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        # An entry replacing an older one of the same request only grows the
+        # cache by the difference
+        replaced = 0
+        for path in (meta_path, body_path):
+            try:
+                replaced += path.stat().st_size
+            except OSError:
+                pass
+        self._write(body_path, entry.content)
+        meta = self._write_meta(meta_path, entry)
+        self._grow(len(entry.content) + len(meta) - replaced)
+        return entry
+
+    def touch(self, method: str, url: str, entry: CachedResponse) -> CachedResponse:
+        """Mark a revalidated entry as fresh again, keeping its body"""
+        entry.stored = time.time()
+        meta_path, _ = self._paths(method, url)
+        self._write_meta(meta_path, entry)
+        return entry
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        # Write then rename so concurrent readers never see partial entries
+        tmp = path.with_suffix(path.suffix + f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+
+    def _write_meta(self, path: Path, entry: CachedResponse) -> bytes:
+        meta = {k: v for k, v in entry.__dict__.items() if k != 'content'}
+        data = json.dumps(meta).encode()
+        self._write(path, data)
+        return data
+
+    def _entries(self):
+        for meta_path in self.root.glob('*/*.json'):
+            body_path = meta_path.with_suffix('.body')
+            try:
+                stat = meta_path.stat()
+                size = stat.st_size + body_path.stat().st_size
+            except OSError:
+                continue
+            yield stat.st_mtime, size, meta_path, body_path
+
+    def _grow(self, n: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(x[1] for x in self._entries())
+            else:
+                self._size += n
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is 90% full
+        """
+        entries = sorted(self._entries())
+        size = sum(x[1] for x in entries)
+        target = int(self.max_bytes * .9)
+        removed = 0
+        for _, n, meta_path, body_path in entries:
+            if size <= target:
+                break
+            for path in (meta_path, body_path):
+                path.unlink(missing_ok=True)
+            size -= n
+            removed += 1
+        self._size = size
+        logging.info(f"Evicted {removed} cached responses")
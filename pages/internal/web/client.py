@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, Optional, Union
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from datetime import datetime, timezone
+from .cache import CachedResponse, RequestKind, ResponseCache
+import logging
+import random
+import time
+import trio
+import asks
+
+if TYPE_CHECKING:
+    # Only for annotations, requests is slow to import
+    from requests import Response
+
+# Statuses which mean "slow down" rather than "this url is broken"
+THROTTLE_STATUS = (429, 503)
+
+# Content types worth downloading when fetching a page
+PAGE_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+
+DEFAULT_HOST_LIMITS = {
+    'hacker-news.firebaseio.com': 32,
+}
+
+
+@dataclass
+class HostState:
+    limiter: trio.CapacityLimiter
+    limit: int
+    not_before: float = 0.
+    streak: int = 0
+
+
+@dataclass
+class RunState:
+    limiter: trio.CapacityLimiter
+    hosts: Dict[str, HostState] = field(default_factory=dict)
+
+
+_RUN_STATE: trio.lowlevel.RunVar[RunState] = trio.lowlevel.RunVar('scheduler')
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header into a delay in seconds
+
+    Args:
+        value (Optional[str]): Either a number of seconds or an HTTP date
+    """
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0., (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def is_page(content_type: Optional[str]) -> bool:
+    """Whether a Content-Type header is a readable page, servers omitting it get the benefit of the doubt"""
+    if not content_type:
+        return True
+    return content_type.split(';')[0].strip().lower() in PAGE_TYPES
+
+
+class HostScheduler:
+    """
+    Request scheduler with a global concurrency cap and adaptive per-host limits.
+
+    Each host starts with ``per_host`` concurrent requests (or its entry in
+    ``host_limits``). A 429/503 halves the host's limit and pauses the host
+    for the Retry-After delay, or an exponential backoff if none was sent.
+    The limit grows back by one after every ``per_host`` successes in a row.
+    Pages are streamed and only read up to ``max_page_bytes``.
+    Limiter state is kept per ``trio.run`` so separate runs do not share it.
+    """
+    def __init__(
+        self,
+        max_connections: int = 64,
+        per_host: int = 8,
+        max_retries: int = 4,
+        backoff: float = 1.,
+        max_backoff: float = 60.,
+        host_limits: Optional[Dict[str, int]] = None,
+        cache: Optional[ResponseCache] = None,
+        max_page_bytes: int = 2 * 1024 ** 2,
+    ) -> None:
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.host_limits = dict(DEFAULT_HOST_LIMITS if host_limits is None else host_limits)
+        self.cache = cache
+        self.max_page_bytes = max_page_bytes
+
+    def configure(self, **kwargs):
+        """Update the scheduler settings, e.g. from the CLI"""
+        for key, value in kwargs.items():
+            if not hasattr(self, key):
+                raise AttributeError(f'Unknown scheduler setting {key}')
+            if value is not None:
+                setattr(self, key, value)
+
+    def _state(self) -> RunState:
+        try:
+            return _RUN_STATE.get()
+        except LookupError:
+            state = RunState(limiter=trio.CapacityLimiter(self.max_connections))
+            _RUN_STATE.set(state)
+            return state
+
+    def _host(self, host: str) -> HostState:
+        hosts = self._state().hosts
+        if host not in hosts:
+            limit = min(self.host_limits.get(host, self.per_host), self.max_connections)
+            hosts[host] = HostState(limiter=trio.CapacityLimiter(limit), limit=limit)
+        return hosts[host]
+
+    def _throttle(self, host: str, state: HostState, delay: Optional[float], attempt: int):
+        state.streak = 0
+        state.limiter.total_tokens = max(1, int(state.limiter.total_tokens) // 2)
+        if delay is None:
+            delay = self.backoff * 2 ** attempt * (1 + random.random())
+        delay = min(delay, self.max_backoff)
+        state.not_before = max(state.not_before, time.monotonic() + delay)
+        logging.info(
+            f"Throttled by {host}, limit now {state.limiter.total_tokens}, "
+            f"pausing {delay:.1f}s"
+        )
+
+    def _recover(self, state: HostState):
+        state.streak += 1
+        tokens = int(state.limiter.total_tokens)
+        if tokens < state.limit and state.streak >= self.per_host:
+            state.limiter.total_tokens = tokens + 1
+            state.streak = 0
+
+    async def request(
+        self, session: asks.Session, method: str, url: str,
+        kind: Optional[RequestKind] = None, **kwargs
+    ) -> Union[Response, CachedResponse]:
+        """
+        Make a request through the response cache and the limiters
+
+        Requests with a ``kind`` are served from the cache while fresh, and
+        revalidated with a conditional request once stale. Throttled
+        responses are retried up to ``max_retries`` times, after which the
+        last response is returned for the caller to handle.
+
+        Args:
+            session (asks.Session): The session to send the request with
+            method (str): The HTTP method
+            url (str): The url to request
+            kind (Optional[RequestKind]): The kind of request, for caching
+        """
+        if self.cache is None or kind is None:
+            return await self._send(session, method, url, **kwargs)
+
+        # The cache reads and writes files, so keep it off the trio loop
+        cache = self.cache
+        entry = await trio.to_thread.run_sync(cache.get, method, url)
+        if entry is not None:
+            if cache.fresh(entry, kind):
+                return entry
+            headers = dict(kwargs.pop('headers', None) or {})
+            headers.update(entry.validators)
+            kwargs['headers'] = headers
+
+        resp = await self._send(session, method, url, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            return await trio.to_thread.run_sync(cache.touch, method, url, entry)
+        # Pages cut short by the caller are incomplete, unlike ones cut at the byte budget
+        if resp.status_code == 200 and not getattr(resp, 'partial', False):
+            await trio.to_thread.run_sync(cache.put, method, url, resp)
+        return resp
+
+    async def _send(
+        self, session: asks.Session, method: str, url: str,
+        reader: Optional[Callable[[Response], Awaitable[None]]] = None,
+        **kwargs
+    ) -> Response:
+        host = urlsplit(url).netloc
+        state = self._host(host)
+        attempt = 0
+        while True:
+            async with state.limiter:
+                wait = state.not_before - time.monotonic()
+                if wait > 0:
+                    await trio.sleep(wait)
+                async with self._state().limiter:
+                    resp: Response = await session.request(method, url, **kwargs)
+                    if reader is not None:
+                        await reader(resp)
+
+            if resp.status_code not in THROTTLE_STATUS:
+                self._recover(state)
+                return resp
+
+            delay = retry_after(resp.headers.get('retry-after'))
+            self._throttle(host, state, delay, attempt)
+            if attempt >= self.max_retries:
+                logging.warning(f"Giving up on {url} after {attempt + 1} attempts")
+                return resp
+            attempt += 1
+
+    async def get(self, session: asks.Session, url: str, **kwargs) -> Response:
+        return await self.request(session, 'GET', url, **kwargs)
+
+    async def head(self, session: asks.Session, url: str, **kwargs) -> Response:
+        return await self.request(session, 'HEAD', url, **kwargs)
+
+    async def fetch_page(
+        self, session: asks.Session, url: str,
+        kind: RequestKind = RequestKind.article,
+        stop: Optional[Callable[[bytes], bool]] = None,
+        timeout: Optional[float] = None,
+        **kwargs
+    ) -> Union[Response, CachedResponse]:
+        """
+        GET a web page, streaming at most ``max_page_bytes`` of it
+
+        The Content-Type is checked before the body is read, so anything
+        which is not a page (PDFs, videos, images, ...) comes back with an
+        empty content. Responses cut short by ``stop`` are not cached.
+
+        Args:
+            session (asks.Session): The session to send the request with
+            url (str): The url of the page
+            kind (RequestKind): The kind of request, for caching
+            stop (Optional[Callable[[bytes], bool]]): Called with each chunk, ends the download by returning True
+            timeout (Optional[float]): The timeout of the request and of each read
+        """
+        async def read(resp):
+            content = bytearray()
+            resp.partial = False
+            async with resp.body(timeout=timeout) as body:
+                if resp.status_code == 200 and is_page(resp.headers.get('content-type')):
+                    async for chunk in body:
+                        content += chunk
+                        if len(content) >= self.max_page_bytes:
+                            del content[self.max_page_bytes:]
+                            logging.debug(f"Cut {url} at {self.max_page_bytes} bytes")
+                            break
+                        if stop is not None and stop(chunk):
+                            resp.partial = True
+                            break
+            resp.content = bytes(content)
+
+        return await self.request(
+            session, 'GET', url, kind=kind,
+            stream=True, reader=read, timeout=timeout, **kwargs
+        )
@@ -0,0 +1,32 @@
+from typing import Tuple
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compress(html: str) -> Tuple[str, bytes]:
+    """
+    Compress html with zstd when available, zlib otherwise
+
+    CPU bound at these levels, so scrapers call it in the parse pool rather
+    than on the trio loop.
+    """
+    raw = html.encode("utf-8", errors="ignore")
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=9).compress(raw)
+    return "zlib", zlib.compress(raw, 9)
+
+
+def decompress(codec: str, data: bytes) -> str:
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed bodies")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == "zlib":
+        raw = zlib.decompress(data)
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    return raw.decode("utf-8", errors="ignore")
@@ -0,0 +1,219 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import exists, insert, select, text, update
+from .schema import Child, Comment
+from .cache import RequestKind
+from .failures import ERRORS, ErrorType
+from .scraper import item_url
+from . import interfaces as inter
+import logging
+import json
+import trio
+
+
+def pending_posts(unseeded: bool = False) -> List[int]:
+    """
+    Get the posts whose comment crawl was cut short, to resume it
+
+    Args:
+        unseeded (bool): Also get the posts with comments which were never
+            crawled, e.g. saved by a retry or before comments were crawled
+
+    Returns:
+        List[int]: The post ids
+    """
+    session = inter.DBMi.session
+    # Only read the unfetched comments, through their partial index, which
+    # SQLite would otherwise pass over for a scan of all the comments
+    output = set(session.scalars(text(
+        'SELECT DISTINCT post_id FROM hn_comments INDEXED BY ix_hn_comments_pending '
+        'WHERE fetched IS 0'
+    )))
+    if unseeded:
+        output.update(session.scalars(
+            select(Child.id)
+            .where(~exists().where(Comment.post_id == Child.id))
+            .distinct()
+        ))
+    return sorted(output)
+
+
+class CommentCrawler:
+    """
+    Breadth-first crawler of the comment trees of posts.
+
+    The top level ``kids`` of each post in ``hn_children`` seed unfetched
+    rows of ``hn_comments``. Every round fetches the shallowest unfetched
+    comments of all the posts at once with bounded concurrency, fills them
+    in and inserts their replies as new unfetched rows. Comments are keyed
+    on their id, so a comment is only ever fetched once and an interrupted
+    crawl resumes from the unfetched rows.
+
+    Args:
+        post_ids (Iterable[int]): The posts to crawl the comments of
+        workers (int): The number of concurrent requests
+        batch_size (int): The number of comments fetched and saved per round
+        max_depth (Optional[int]): The deepest level of replies to fetch
+        max_comments (Optional[int]): The most comments fetched per post and crawl
+        limit (Optional[int]): The most comments fetched by the crawl, the rest
+            stay unfetched for a later crawl to resume from
+        progress (Optional[Callable[[], None]]): Called after every fetched comment
+    """
+    def __init__(
+        self,
+        post_ids: Iterable[int],
+        workers: int = 32,
+        batch_size: int = 500,
+        max_depth: Optional[int] = None,
+        max_comments: Optional[int] = 1000,
+        limit: Optional[int] = None,
+        progress: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.post_ids = list(post_ids)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+        self.max_comments = max_comments
+        self.limit = limit
+        self.progress = progress
+
+        self.n_comments = 0
+        self.fetched: Dict[int, int] = {}
+
+    def seed(self, chunk_size: int = 500):
+        """Add the top level comments of the posts as unfetched rows"""
+        session = inter.DBMi.session
+        for x in range(0, len(self.post_ids), chunk_size):
+            kids = session.execute(
+                select(Child.id, Child.child).where(Child.id.in_(self.post_ids[x:x + chunk_size]))
+            ).all()
+            if kids:
+                session.execute(
+                    insert(Comment).prefix_with('OR IGNORE'),
+                    [
+                        {'id': int(kid), 'post_id': post_id, 'parent': post_id, 'depth': 1}
+                        for post_id, kid in kids
+                    ]
+                )
+        session.commit()
+
+    def frontier(self, skip: Iterable[int] = ()) -> List[Tuple[int, int, int]]:
+        """
+        Get the next round of comments to fetch, shallowest first
+
+        Args:
+            skip (Iterable[int]): Comments which already failed during this crawl
+
+        Returns:
+            List[Tuple[int, int, int]]: The id, post id and depth of each comment
+        """
+        active = [
+            x for x in self.post_ids
+            if self.max_comments is None or self.fetched.get(x, 0) < self.max_comments
+        ]
+        size = self.batch_size
+        if self.limit is not None:
+            size = min(size, self.limit - sum(self.fetched.values()))
+        if not active or size <= 0:
+            return []
+        stmnt = (
+            select(Comment.id, Comment.post_id, Comment.depth)
+            .where(Comment.fetched.is_(False), Comment.post_id.in_(active))
+            .order_by(Comment.depth, Comment.id)
+            .limit(size)
+        )
+        if self.max_depth is not None:
+            stmnt = stmnt.where(Comment.depth <= self.max_depth)
+        skip = list(skip)
+        if skip:
+            stmnt = stmnt.where(Comment.id.not_in(skip))
+
+        output = []
+        taken: Dict[int, int] = {}
+        for comment_id, post_id, depth in inter.DBMi.session.execute(stmnt):
+            count = self.fetched.get(post_id, 0) + taken.get(post_id, 0)
+            if self.max_comments is None or count < self.max_comments:
+                taken[post_id] = taken.get(post_id, 0) + 1
+                output.append((comment_id, post_id, depth))
+        return output
+
+    async def fetch(self, comment_id: int) -> Tuple[Optional[Dict], bool]:
+        """
+        Get a comment from the api
+
+        Returns:
+            Tuple[Optional[Dict], bool]: The comment, None if it no longer exists, and whether the request worked
+        """
+        url = item_url(comment_id)
+        err = None
+        item = None
+        try:
+            resp = await inter.SCHED.get(inter.SESS, url, kind=RequestKind.item, timeout=10)
+            if resp.status_code == 200:
+                item = json.loads(resp.content.decode('utf-8', errors='ignore'))
+            else:
+                err = (ErrorType.resp, 'no response')
+        except* Exception as e:
+            err = (ErrorType.url, str(e.__class__))
+        if err is not None:
+            ERRORS.record(url, *err)
+            return None, False
+        return item, True
+
+    def save(self, rows: List[Tuple[int, int, int]], items: List[Optional[Dict]]):
+        """Fill in a round of fetched comments and queue their replies"""
+        comments = []
+        replies = []
+        for (comment_id, post_id, depth), item in zip(rows, items):
+            item = item or {'deleted': True}
+            comments.append({
+                'id': comment_id,
+                'fetched': True,
+                'author': item.get('by'),
+                'time': datetime.fromtimestamp(item['time']) if 'time' in item else None,
+                'text': item.get('text'),
+                'deleted': bool(item.get('deleted', False)),
+                'dead': bool(item.get('dead', False)),
+            })
+            replies.extend(
+                {'id': kid, 'post_id': post_id, 'parent': comment_id, 'depth': depth + 1}
+                for kid in item.get('kids', [])
+            )
+            self.fetched[post_id] = self.fetched.get(post_id, 0) + 1
+
+        session = inter.DBMi.session
+        if comments:
+            session.execute(update(Comment), comments)
+        if replies:
+            session.execute(insert(Comment).prefix_with('OR IGNORE'), replies)
+        ERRORS.flush(session)
+        session.commit()
+        self.n_comments += len(comments)
+
+    async def crawl(self):
+        """Fetch rounds of comments until the trees or the budgets are exhausted"""
+        limiter = trio.CapacityLimiter(self.workers)
+        failed = set()
+        while rows := self.frontier(failed):
+            results: List[Tuple[Optional[Dict], bool]] = [(None, False)] * len(rows)
+
+            async def fetch(ind: int, comment_id: int):
+                async with limiter:
+                    results[ind] = await self.fetch(comment_id)
+                if self.progress is not None:
+                    self.progress()
+
+            async with trio.open_nursery() as n:
+                for ind, (comment_id, _, _) in enumerate(rows):
+                    n.start_soon(fetch, ind, comment_id)
+
+            # Failed comments stay unfetched for the next crawl
+            done = [(row, item) for row, (item, ok) in zip(rows, results) if ok]
+            failed.update(row[0] for row, (_, ok) in zip(rows, results) if not ok)
+            if done:
+                self.save([x[0] for x in done], [x[1] for x in done])
+
+    def run(self):
+        self.seed()
+        trio.run(self.crawl)
+        logging.info(f"Fetched {self.n_comments} comments of {len(self.post_ids)} posts")
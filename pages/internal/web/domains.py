@@ -0,0 +1,62 @@
+from typing import Optional
+from urllib.parse import urlsplit
+import ipaddress
+
+# Public suffixes spanning more than one label, so ``bbc.co.uk`` is not
+# lumped into ``co.uk``. Not the full public suffix list, only the suffixes
+# which commonly show up on Hacker News.
+MULTI_LABEL_SUFFIXES = {
+    # Second level country domains
+    'ac.uk', 'co.uk', 'gov.uk', 'ltd.uk', 'me.uk', 'net.uk', 'org.uk', 'plc.uk',
+    'com.au', 'edu.au', 'gov.au', 'net.au', 'org.au',
+    'ac.jp', 'co.jp', 'ne.jp', 'or.jp',
+    'ac.nz', 'co.nz', 'govt.nz', 'net.nz', 'org.nz',
+    'co.in', 'ac.in', 'gov.in', 'net.in', 'org.in',
+    'com.br', 'gov.br', 'net.br', 'org.br',
+    'com.cn', 'edu.cn', 'gov.cn', 'net.cn', 'org.cn',
+    'co.kr', 'ac.kr', 'or.kr',
+    'co.za', 'org.za', 'ac.za',
+    'com.sg', 'edu.sg', 'gov.sg',
+    'com.hk', 'edu.hk', 'org.hk',
+    'com.tw', 'edu.tw', 'org.tw',
+    'com.mx', 'com.ar', 'com.tr', 'com.ua', 'com.pl', 'co.il', 'ac.il',
+    # Hosting platforms where every subdomain belongs to someone else
+    'github.io', 'gitlab.io', 'blogspot.com', 'herokuapp.com', 'netlify.app',
+    'vercel.app', 'pages.dev', 'workers.dev', 'fly.dev', 'web.app',
+    'firebaseapp.com', 'appspot.com', 'azurewebsites.net', 'cloudfront.net',
+    'neocities.org', 'srht.site', 'codeberg.page', 'bearblog.dev',
+}
+
+
+def registrable_domain(url: Optional[str]) -> Optional[str]:
+    """
+    Get the registrable domain of a url, e.g. ``bbc.co.uk`` for
+    ``https://www.bbc.co.uk/news``
+
+    Args:
+        url (Optional[str]): The url to get the domain of
+
+    Returns:
+        Optional[str]: The lower cased registrable domain, or the host for IPs
+    """
+    if not url:
+        return None
+    try:
+        host = urlsplit(url.strip()).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    host = host.rstrip('.').lower()
+
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+
+    labels = host.split('.')
+    if len(labels) <= 2:
+        return host
+    suffix = 2 if '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES else 1
+    return '.'.join(labels[-(suffix + 1):])
@@ -0,0 +1,231 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import urljoin
+from .codec import compress
+import multiprocessing
+import codecs
+import threading
+import trio
+import re
+
+# Tags whose contents are never readable text
+SKIP_TAGS = {'script', 'style', 'noscript', 'template', 'svg', 'head'}
+WHITESPACE = re.compile(r'\s+')
+
+# Meta tags naming the preview image of a page, in order of preference
+IMAGE_META = ('og:image', 'og:image:url', 'og:image:secure_url', 'twitter:image', 'twitter:image:src')
+
+
+class TextExtractor(HTMLParser):
+    """
+    Collect the readable text of a page, up to ``limit`` characters
+    """
+    def __init__(self, limit: Optional[int] = None) -> None:
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts: List[str] = []
+        self.length = 0
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if self._skip or (self.limit is not None and self.length >= self.limit):
+            return
+        data = data.strip()
+        if data:
+            self.parts.append(data)
+            self.length += len(data) + 1
+
+
+def html_to_text(html: Optional[str], limit: Optional[int] = 100_000) -> Optional[str]:
+    """
+    Get the readable text of some html
+
+    Args:
+        html (Optional[str]): The html to extract the text of
+        limit (Optional[int]): The maximum number of characters to keep
+
+    Returns:
+        Optional[str]: The whitespace normalized text
+    """
+    if not html:
+        return None
+    parser = TextExtractor(limit)
+    try:
+        parser.feed(html)
+        parser.close()
+    except AssertionError:
+        # HTMLParser gives up on some malformed markup, keep what was read
+        pass
+    text = WHITESPACE.sub(' ', ' '.join(parser.parts)).strip()
+    return text[:limit] if limit is not None else text
+
+
+class StopParsing(Exception):
+    """Raised by a parser once it has everything it needs"""
+
+
+class HeadParser(HTMLParser):
+    """
+    Collect the title, description and preview image of a page.
+
+    Parsing stops at the first ``<img>``, as a page's preview image meta tags
+    all come before it, so the rest of the page is never read.
+    """
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.title: Optional[str] = None
+        self.description: Optional[str] = None
+        self.meta_img: Optional[str] = None
+        self.first_img: Optional[str] = None
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            name = (attrs.get('property') or attrs.get('name') or '').lower()
+            content = (attrs.get('content') or '').strip()
+            if not content:
+                return
+            if name in IMAGE_META and self.meta_img is None:
+                self.meta_img = content
+            elif name in ('description', 'og:description') and self.description is None:
+                self.description = content
+        elif tag == 'title':
+            self._in_title = True
+        elif tag == 'img':
+            src = (dict(attrs).get('src') or '').strip()
+            if src:
+                self.first_img = src
+                raise StopParsing
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head' and self.meta_img is not None:
+            raise StopParsing
+
+    def handle_data(self, data):
+        if self._in_title and self.title is None and data.strip():
+            self.title = data.strip()
+
+    @property
+    def image(self) -> Optional[str]:
+        return self.meta_img or self.first_img
+
+
+class ImageProbe:
+    """
+    Parse a page as it downloads, until its preview image is known.
+
+    Meant as the ``stop`` callback of ``HostScheduler.fetch_page``, so the
+    download ends at the first ``og:image``/``twitter:image`` or ``<img>``,
+    or after ``limit`` bytes without either.
+    """
+    def __init__(self, limit: int = 256 * 1024) -> None:
+        self.parser = HeadParser()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        self.limit = limit
+        self.length = 0
+        self.done = False
+
+    def feed(self, chunk: bytes) -> bool:
+        if not self.done:
+            self.length += len(chunk)
+            try:
+                self.parser.feed(self.decoder.decode(chunk))
+            except (StopParsing, AssertionError):
+                self.done = True
+            self.done = self.done or self.length >= self.limit
+        return self.done
+
+
+@dataclass
+class PageInfo:
+    """The compact result of parsing a page, with its compressed html if asked for"""
+    img: Optional[str] = None
+    title: Optional[str] = None
+    description: Optional[str] = None
+    text: Optional[str] = None
+    body: Optional[Tuple[str, bytes]] = None
+
+
+def parse_head(html: str) -> HeadParser:
+    parser = HeadParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except (StopParsing, AssertionError):
+        pass
+    return parser
+
+
+def analyze_page(
+    url: str, html: str, text_limit: Optional[int] = 100_000, archive: bool = False,
+) -> PageInfo:
+    """
+    Extract the image, metadata and readable text of a page in one go
+
+    Meant to run in the parse pool, so only the compact result is sent back.
+
+    Args:
+        url (str): The url of the page, used to resolve relative sources
+        html (str): The html of the page
+        text_limit (Optional[int]): The maximum number of characters of text to keep
+        archive (bool): Also compress the html, for the post's archived body
+
+    Returns:
+        PageInfo: The absolute url (or data uri) of the image, title, description and text
+    """
+    head = parse_head(html)
+    img = head.image
+    if img is not None and not img.startswith('data:image'):
+        img = urljoin(url, img)
+    return PageInfo(
+        img=img,
+        title=head.title,
+        description=head.description,
+        text=html_to_text(html, text_limit),
+        body=compress(html) if archive else None,
+    )
+
+
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+POOL_WORKERS: Optional[int] = None
+
+
+def configure(max_workers: Optional[int]):
+    """Set the number of parse processes, before the pool is first used"""
+    global POOL_WORKERS
+    POOL_WORKERS = max_workers
+
+
+def pool() -> ProcessPoolExecutor:
+    """Get the process pool for CPU bound parsing, started on first use"""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Forking a process running the web server and trio is unsafe
+            _POOL = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _POOL
+
+
+async def run_in_pool(func: Callable[..., Any], *args) -> Any:
+    """
+    Run ``func(*args)`` in the parse pool without blocking the trio loop
+    """
+    future = pool().submit(func, *args)
+    return await trio.to_thread.run_sync(future.result, abandon_on_cancel=True)
@@ -0,0 +1,187 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+from datetime import datetime, timedelta
+from enum import Enum
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from .schema import Failure
+import threading
+import logging
+import random
+
+
+class ErrorType(Enum):
+    """
+    Scraping Error Types
+    """
+    url = 'url'
+    img = 'image'
+    bing = 'bing image'
+    resp = 'no response'
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Exponential backoff with jitter for one type of failure
+
+    Args:
+        base (float): The delay in seconds before the first retry
+        max_delay (float): The longest delay in seconds between retries
+        max_attempts (int): The number of retries before giving up
+    """
+    base: float
+    max_delay: float
+    max_attempts: int
+
+    def delay(self, count: int) -> Optional[float]:
+        """The delay before retrying after ``count`` failures, None to give up"""
+        if count > self.max_attempts:
+            return None
+        delay = min(self.max_delay, self.base * 2 ** (count - 1))
+        return delay * random.uniform(.5, 1.5)
+
+
+HOUR = 60 * 60
+RETRY_POLICY = {
+    ErrorType.url: RetryPolicy(base=5 * 60, max_delay=24 * HOUR, max_attempts=8),
+    ErrorType.resp: RetryPolicy(base=HOUR, max_delay=7 * 24 * HOUR, max_attempts=6),
+    ErrorType.img: RetryPolicy(base=HOUR, max_delay=7 * 24 * HOUR, max_attempts=5),
+    # Bing searches are made on demand from the UI
+    ErrorType.bing: RetryPolicy(base=0, max_delay=0, max_attempts=0),
+}
+
+
+@dataclass
+class PendingFailure:
+    type: ErrorType
+    description: str
+    count: int
+    first_failed: datetime
+    last_failed: datetime
+    post_id: Optional[int] = None
+    date_added: Optional[datetime] = None
+
+
+class ErrorSink:
+    """
+    In-memory buffer of scraping failures, written to ``url_failures`` in batches.
+
+    Scraper tasks only ``record`` failures and ``resolve`` urls which
+    succeeded, the database is touched once per ``flush``. Each url keeps one
+    row with its failure count. Failures tied to a post are given a
+    ``next_retry`` time from the ``RetryPolicy`` of their type.
+    """
+    def __init__(self, policy: Optional[Dict[ErrorType, RetryPolicy]] = None) -> None:
+        self.policy = dict(RETRY_POLICY if policy is None else policy)
+        self._pending: Dict[str, PendingFailure] = {}
+        self._resolved: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def record(
+        self, url: str, type: ErrorType, description: str,
+        post_id: Optional[int] = None, date_added: Optional[datetime] = None,
+    ):
+        """
+        Buffer a failure
+
+        Args:
+            url (str): The url which failed
+            type (ErrorType): The kind of failure
+            description (str): What went wrong
+            post_id (Optional[int]): The post the url belongs to, making it retryable
+            date_added (Optional[datetime]): The bookmark time, for retrying items
+        """
+        now = datetime.now()
+        with self._lock:
+            self._resolved.discard(url)
+            pending = self._pending.get(url)
+            if pending is None:
+                self._pending[url] = PendingFailure(
+                    type=type, description=description, count=1,
+                    first_failed=now, last_failed=now,
+                    post_id=post_id, date_added=date_added,
+                )
+            else:
+                pending.type = type
+                pending.description = description
+                pending.count += 1
+                pending.last_failed = now
+                pending.post_id = post_id if post_id is not None else pending.post_id
+                pending.date_added = date_added or pending.date_added
+
+    def resolve(self, url: str):
+        """Forget the failures of a url which has now succeeded"""
+        with self._lock:
+            self._pending.pop(url, None)
+            self._resolved.add(url)
+
+    def flush(self, session: Session, chunk_size: int = 500):
+        """
+        Write the buffered failures, the caller commits
+
+        Args:
+            session (Session): The session to write with
+            chunk_size (int): The number of urls per statement
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            resolved, self._resolved = self._resolved, set()
+
+        resolved = list(resolved)
+        for x in range(0, len(resolved), chunk_size):
+            session.execute(delete(Failure).where(Failure.url.in_(resolved[x:x + chunk_size])))
+
+        urls = list(pending)
+        for x in range(0, len(urls), chunk_size):
+            chunk = urls[x:x + chunk_size]
+            existing = {
+                url: (count, first_failed)
+                for url, count, first_failed in session.execute(
+                    select(Failure.url, Failure.count, Failure.first_failed)
+                    .where(Failure.url.in_(chunk))
+                )
+            }
+            rows = []
+            for url in chunk:
+                failure = pending[url]
+                count, first_failed = existing.get(url, (0, failure.first_failed))
+                count += failure.count
+                delay = self.policy[failure.type].delay(count)
+                retryable = failure.post_id is not None and delay is not None
+                rows.append({
+                    'url': url,
+                    'type': failure.type.value,
+                    'description': failure.description,
+                    'count': count,
+                    'first_failed': first_failed,
+                    'last_failed': failure.last_failed,
+                    'next_retry': failure.last_failed + timedelta(seconds=delay) if retryable else None,
+                    'post_id': failure.post_id,
+                    'date_added': failure.date_added,
+                })
+            stmnt = insert(Failure)
+            session.execute(
+                stmnt.on_conflict_do_update(
+                    index_elements=[Failure.url],
+                    set_={
+                        'type': stmnt.excluded.type,
+                        'description': stmnt.excluded.description,
+                        'count': stmnt.excluded.count,
+                        'last_failed': stmnt.excluded.last_failed,
+                        'next_retry': stmnt.excluded.next_retry,
+                        'post_id': func.coalesce(stmnt.excluded.post_id, Failure.post_id),
+                        'date_added': func.coalesce(stmnt.excluded.date_added, Failure.date_added),
+                    }
+                ),
+                rows
+            )
+        if pending:
+            logging.info(f'Recorded failures of {len(pending)} urls')
+
+
+ERRORS = ErrorSink()
@@ -0,0 +1,655 @@
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+from datetime import datetime, timedelta
+from functools import partial
+from pathlib import Path
+from enum import Enum
+from collections import defaultdict
+from sqlalchemy import Row, exists, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from .bookmarks import BookmarkDiff
+from .comments import CommentCrawler, pending_posts
+from .refresh import PostRefresher
+from .failures import ERRORS, ErrorType
+from .extract import PageInfo, html_to_text
+from .schema import DB_PATH, Failure, Meta, Post, PostBody
+from .scraper import ImageStatus, MultiScraper, item_url, validate_images
+from .search import index_posts
+from .throughput import LiveReport, Throughput
+from . import interfaces as inter
+from . import stats
+import threading
+import hashlib
+import trio
+import logging
+import queue
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Images checked more recently than this are not checked again
+IMAGE_TTL = timedelta(days=7)
+IMAGE_CHECK = 'images'
+# Page loads queue a refresh or a retry at most this often
+REFRESH_INTERVAL = timedelta(minutes=10)
+RETRY_INTERVAL = timedelta(minutes=5)
+# Comment crawls hold the ingest lock, so each job only crawls this many
+# posts and fetches this many comments, leaving the rest for a later job
+CRAWL_POSTS = 50
+CRAWL_LIMIT = 2000
+LAST_REFRESH = 'last_refresh'
+LAST_RETRY = 'last_retry'
+
+
+class JobState(Enum):
+    """
+    Ingestion Job States
+    """
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+    failed = 'failed'
+    cancelled = 'cancelled'
+    skipped = 'skipped'
+
+
+@dataclass
+class Job:
+    key: str
+    target: Callable[..., Any] = field(repr=False)
+    args: tuple = field(default=(), repr=False)
+    label: str = 'Working'
+    state: JobState = JobState.queued
+    progress: int = 0
+    total: int = 0
+    message: str = ''
+    created: datetime = field(default_factory=datetime.now)
+    finished: Optional[datetime] = None
+    cancelled: bool = False
+
+    def advance(self, n: int = 1):
+        self.progress += n
+
+    def cancel(self):
+        """Ask the job to stop, long running targets poll ``cancelled``"""
+        self.cancelled = True
+
+    @property
+    def active(self) -> bool:
+        return self.state in (JobState.queued, JobState.running)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'key': self.key,
+            'label': self.label,
+            'state': self.state.value,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'created': self.created.isoformat(),
+            'finished': self.finished.isoformat() if self.finished else None,
+        }
+
+
+class IngestLock:
+    """
+    Lock file next to the database, held while a process ingests.
+
+    Only one process writes to the database at a time, e.g. one of the
+    server's worker processes or the ``ingest`` command. Within it, only the
+    ingest worker's thread writes, and the web requests read through the
+    read-only engine. Anything else waits on SQLite's ``busy_timeout``.
+    Without ``fcntl``
+    the lock only excludes the threads of this process.
+
+    Args:
+        path (Path): The lock file
+    """
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._fp = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Take the lock
+
+        Args:
+            blocking (bool): Wait for another process to release the lock
+
+        Returns:
+            bool: Whether the lock was taken
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        if fcntl is None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fp = open(self.path, 'a')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            fp.close()
+            self._lock.release()
+            return False
+        self._fp = fp
+        return True
+
+    def release(self):
+        if self._fp is not None:
+            fcntl.flock(self._fp, fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+INGEST_LOCK = IngestLock(DB_PATH.parent / f'{DB_PATH.name}.ingest.lock')
+
+
+class IngestWorker:
+    """
+    Background worker which runs ingestion jobs one at a time, off the
+    request thread.
+
+    Jobs are deduplicated by key: submitting a key which is already queued
+    or running returns the existing job instead of scheduling another one.
+    A job is skipped when another process holds the ``INGEST_LOCK``, as with
+    several server workers only one of them ingests at a time.
+    """
+    def __init__(self, history: int = 20) -> None:
+        self.history = history
+        self.jobs: Dict[str, Job] = {}
+        self.finished: List[Job] = []
+        self.completed = 0
+        self._queue: queue.Queue[Job] = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(
+        self, key: str, target: Callable[..., Any], *args, label: str = 'Working'
+    ) -> Job:
+        """
+        Queue a job unless one with the same key is already pending
+
+        Args:
+            key (str): The deduplication key of the job
+            target (Callable): Called as ``target(job, *args)`` on the worker thread
+            label (str): The description of the job shown in the UI
+
+        Returns:
+            Job: The queued job, or the pending job with the same key
+        """
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is not None and job.active:
+                return job
+            job = Job(key=key, target=target, args=args, label=label)
+            self.jobs[key] = job
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='ingest-worker', daemon=True
+                )
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                # Cancelled while still queued
+                job.state = JobState.cancelled
+            elif not INGEST_LOCK.acquire(blocking=False):
+                logging.info(f"Skipping ingestion job {job.key}, another process is ingesting")
+                job.message = 'Another process is ingesting'
+                job.state = JobState.skipped
+            else:
+                job.state = JobState.running
+                logging.info(f"Starting ingestion job {job.key}")
+                try:
+                    job.target(job, *job.args)
+                    job.state = JobState.cancelled if job.cancelled else JobState.done
+                except Exception as e:
+                    logging.exception(f"Ingestion job {job.key} failed")
+                    job.message = str(e)
+                    job.state = JobState.failed
+                finally:
+                    inter.DBMi.remove()
+                    INGEST_LOCK.release()
+            job.finished = datetime.now()
+            with self._lock:
+                self.finished.append(job)
+                self.finished = self.finished[-self.history:]
+                self.completed += 1
+            self._queue.task_done()
+
+    def cancel(self, key: str) -> Optional[Job]:
+        """
+        Cancel the pending job with ``key``, if any
+
+        Returns:
+            Optional[Job]: The cancelled job
+        """
+        with self._lock:
+            job = self.jobs.get(key)
+            if job is None or not job.active:
+                return None
+            job.cancel()
+            return job
+
+    @property
+    def busy(self) -> bool:
+        return any(job.active for job in list(self.jobs.values()))
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Get a JSON serializable snapshot of the pending and recent jobs
+        """
+        with self._lock:
+            return {
+                'busy': self.busy,
+                'active': [x.to_dict() for x in self.jobs.values() if x.active],
+                'recent': [x.to_dict() for x in reversed(self.finished)],
+                'completed': self.completed,
+            }
+
+
+def sync_bookmarks(
+    job: Job, path: Path, workers: int = 32, dry_run: bool = False,
+    throughput: Optional[Throughput] = None, crawl: bool = True,
+) -> int:
+    """
+    Scrape the bookmarks in ``path`` which are not in the database yet
+
+    Args:
+        job (Job): The job to report progress on
+        path (Path): The bookmarks file to sync
+        workers (int): The number of concurrent scraper workers
+        dry_run (bool): Scrape the new bookmarks without saving anything
+        throughput (Optional[Throughput]): Collects the throughput of each stage
+        crawl (bool): Queue a crawl of the comments of the new bookmarks, and
+            resume the crawls which were cut short
+
+    Returns:
+        int: The number of scraped posts
+    """
+    if throughput is not None:
+        throughput.start('diff')
+    diff = BookmarkDiff(path)
+    new = diff.new_bookmarks()
+    if throughput is not None:
+        throughput.record('diff', os.path.getsize(diff.path), items=len(new))
+    new_bookmarks = {
+        post_id: (added, item_url(post_id))
+        for post_id, added in new
+    }
+    job.total = len(new_bookmarks)
+    job.message = f'{job.total} new bookmarks'
+    n_posts = 0
+    if new_bookmarks:  # Only create scraper if there are new bookmarks
+        scraper = MultiScraper(
+            new_bookmarks, progress=job.advance, workers=workers,
+            throughput=throughput, dry_run=dry_run,
+        )
+        scraper.save()
+        n_posts = scraper.n_posts
+    if crawl and not dry_run:
+        submit_comment_crawl([post_id for post_id, _ in new] + pending_posts())
+    if not dry_run:
+        diff.mark_synced()
+    return n_posts
+
+
+def ingest_bookmarks(
+    path: Path, workers: int = 32, dry_run: bool = False, interval: float = 2.,
+    comments: bool = True,
+) -> Dict[str, Any]:
+    """
+    Sync a bookmarks file on the calling thread, without the web app
+
+    The throughput of each stage is printed to stderr every ``interval``
+    seconds while the sync runs. Waits for the ``INGEST_LOCK`` when another
+    process, such as the web app, is ingesting. Then the comments of the
+    bookmarks are crawled, resuming the crawls which were cut short, in jobs
+    of ``CRAWL_POSTS`` which each take the lock in turn.
+
+    Args:
+        path (Path): The bookmarks file to sync
+        workers (int): The number of concurrent scraper workers
+        dry_run (bool): Scrape the new bookmarks without saving anything
+        interval (float): Seconds between live reports, 0 to disable them
+        comments (bool): Crawl the comments after the sync
+
+    Returns:
+        Dict[str, Any]: A JSON serializable summary of the run and its stages
+    """
+    path = Path(path).resolve()
+    throughput = Throughput()
+    job = Job(key=f'bookmarks:{path}', target=sync_bookmarks, label='Syncing')
+    if not INGEST_LOCK.acquire(blocking=False):
+        logging.warning('Another process is ingesting, waiting for it to finish')
+        INGEST_LOCK.acquire()
+    try:
+        with LiveReport(throughput, interval):
+            n_posts = sync_bookmarks(
+                job, path, workers=workers, dry_run=dry_run,
+                throughput=throughput, crawl=False,
+            )
+    finally:
+        INGEST_LOCK.release()
+
+    n_comments = 0
+    if comments and not dry_run:
+        post_ids = pending_posts(unseeded=True)
+        for x in range(0, len(post_ids), CRAWL_POSTS):
+            chunk = post_ids[x:x + CRAWL_POSTS]
+            with INGEST_LOCK:
+                n_comments += crawl_comments(
+                    Job(key='comments', target=crawl_comments, label='Fetching comments'), chunk
+                )
+            inter.DBMi.remove()
+
+    output: Dict[str, Any] = {
+        'path': str(path),
+        'dry_run': dry_run,
+        'new': job.total,
+        'saved': 0 if dry_run else n_posts,
+        'scraped': n_posts,
+        'comments': n_comments,
+    }
+    output.update(throughput.to_dict())
+    return output
+
+
+def crawl_comments(job: Job, post_ids: List[int]) -> int:
+    """
+    Fetch the comment trees of posts, up to ``CRAWL_LIMIT`` comments
+
+    Args:
+        job (Job): The job to report progress on
+        post_ids (List[int]): The posts to fetch the comments of
+
+    Returns:
+        int: The number of fetched comments
+    """
+    crawler = CommentCrawler(post_ids, limit=CRAWL_LIMIT, progress=job.advance)
+    # Every comment is a descendant, so this is the size of the trees
+    descendants = inter.DBMi.session.scalars(
+        select(Post.descendants).where(Post.id.in_(post_ids))
+    )
+    job.total = min(
+        sum(min(x or 0, crawler.max_comments or x or 0) for x in descendants), CRAWL_LIMIT
+    )
+    job.message = f'{job.total} comments of {len(post_ids)} posts'
+    crawler.run()
+    job.message = f'{crawler.n_comments} comments of {len(post_ids)} posts'
+    return crawler.n_comments
+
+
+def refresh_posts(job: Job):
+    """Refresh the score and descendants of the bookmarks which changed"""
+    mark_run(LAST_REFRESH)
+    refresher = PostRefresher(progress=job.advance)
+    refresher.run()
+    job.total = job.progress
+    job.message = f'{refresher.n_refreshed} posts refreshed'
+
+
+def ran_within(key: str, interval: timedelta) -> bool:
+    """
+    Check whether the periodic job ``key`` ran within ``interval``, in any process
+
+    Args:
+        key (str): The ``db_meta`` key of the job's last run
+        interval (timedelta): The minimum time between runs
+    """
+    last = inter.DBMi.reader.scalar(select(Meta.value).where(Meta.key == key))
+    return last is not None and datetime.now().timestamp() - last < interval.total_seconds()
+
+
+def mark_run(key: str):
+    """Record the start of a run of the periodic job ``key``"""
+    session = inter.DBMi.session
+    stmnt = insert(Meta).values(key=key, value=int(datetime.now().timestamp()))
+    session.execute(stmnt.on_conflict_do_update(
+        index_elements=[Meta.key], set_={'value': stmnt.excluded.value}
+    ))
+    session.commit()
+
+
+WORKER = IngestWorker()
+
+
+def submit_sync(path: Path) -> Job:
+    """Queue a bookmark sync for ``path``, deduplicated per file"""
+    path = Path(path).resolve()
+    return WORKER.submit(f'bookmarks:{path}', sync_bookmarks, path, label='Syncing')
+
+
+def submit_refresh(force: bool = False) -> Optional[Job]:
+    """
+    Queue a refresh of the bookmarks' scores and comment counts
+
+    Args:
+        force (bool): Queue it even if a refresh ran within ``REFRESH_INTERVAL``
+
+    Returns:
+        Optional[Job]: The queued job, None if a refresh ran recently
+    """
+    if not force and ran_within(LAST_REFRESH, REFRESH_INTERVAL):
+        return None
+    return WORKER.submit('refresh', refresh_posts, label='Refreshing')
+
+
+def submit_comment_crawl(post_ids: List[int]) -> List[Job]:
+    """
+    Queue crawls of the comments of ``post_ids``, after any pending crawl
+
+    The posts are split into jobs of ``CRAWL_POSTS``, each keyed on its set
+    of post ids, so the ingest lock is released between them.
+
+    Returns:
+        List[Job]: The queued jobs, or the pending jobs of the same posts
+    """
+    post_ids = sorted(set(post_ids))
+    jobs = []
+    for x in range(0, len(post_ids), CRAWL_POSTS):
+        chunk = post_ids[x:x + CRAWL_POSTS]
+        key = hashlib.sha1(','.join(map(str, chunk)).encode()).hexdigest()[:16]
+        jobs.append(WORKER.submit(
+            f'comments:{key}', crawl_comments, chunk, label='Fetching comments'
+        ))
+    return jobs
+
+
+def check_images(job: Job, ttl: timedelta):
+    """
+    Validate the post images which were not checked within ``ttl``
+
+    Images whose last check failed to reach their host are checked again
+    regardless of the ttl.
+
+    Args:
+        job (Job): The job to report progress on, and to poll for cancellation
+        ttl (timedelta): How long the result of a check is trusted for
+    """
+    stale = datetime.now() - ttl
+    images = inter.DBMi.session.execute(
+        select(Post.id, Post.img)
+        .where(
+            Post.img.is_not(None),
+            or_(
+                Post.img_checked.is_(None),
+                Post.img_checked < stale,
+                Post.img_status == ImageStatus.error.value,
+            )
+        )
+        .order_by(Post.img_checked)
+    ).all()
+    job.total = len(images)
+    job.message = f'{job.total} images to check'
+    if not images:
+        return
+    counts = trio.run(partial(
+        validate_images, [tuple(x) for x in images],
+        progress=job.advance, cancelled=lambda: job.cancelled,
+    ))
+    job.message = ', '.join(f'{n} {status.value}' for status, n in counts.items())
+    logging.info(f'Checked {sum(counts.values())} images: {job.message}')
+
+
+def submit_image_check(ttl: Optional[timedelta] = None) -> Job:
+    """Queue a check of the post images older than ``ttl``, ``IMAGE_TTL`` by default"""
+    return WORKER.submit(
+        IMAGE_CHECK, check_images, ttl or IMAGE_TTL, label='Checking images'
+    )
+
+
+class RetryScheduler:
+    """
+    Retry the failed urls of posts once their backoff has passed.
+
+    Due failures are grouped by ``ErrorType``. Items which could not be
+    fetched are scraped again. Posts whose page could not be read have it
+    fetched again, for their image, their archived html and their search
+    text, whichever they still lack. Retries report to the ``ErrorSink``, so
+    another failure pushes the url further back and a success clears it.
+
+    Args:
+        limit (int): The maximum number of urls retried per run
+    """
+    def __init__(self, limit: int = 1000) -> None:
+        self.limit = limit
+
+    def due(self, now: Optional[datetime] = None) -> Dict[ErrorType, List[Failure]]:
+        """Get the failures due for a retry, by type"""
+        failures = inter.DBMi.session.scalars(
+            select(Failure)
+            .where(Failure.next_retry <= (now or datetime.now()))
+            .order_by(Failure.next_retry)
+            .limit(self.limit)
+        )
+        output = defaultdict(list)
+        for failure in failures:
+            output[ErrorType(failure.type)].append(failure)
+        return output
+
+    def run(self, job: Job):
+        """Retry the due failures, as an ingest job"""
+        mark_run(LAST_RETRY)
+        session = inter.DBMi.session
+        due = self.due()
+        failed = [x for kind in (ErrorType.url, ErrorType.resp) for x in due[kind]]
+
+        # Items are retried by scraping them again, unless saved since
+        items = [x for x in failed if x.date_added is not None]
+        saved = set(session.scalars(
+            select(Post.id).where(Post.id.in_([x.post_id for x in items]))
+        ))
+        links = {}
+        for failure in items:
+            if failure.post_id in saved:
+                ERRORS.resolve(failure.url)
+            else:
+                links[failure.post_id] = (failure.date_added, failure.url)
+
+        # Pages are retried while their post lacks an image or archived html
+        pages = due[ErrorType.img] + [x for x in failed if x.date_added is None]
+        missing = {
+            row.id: row for row in session.execute(
+                select(
+                    Post.id, Post.url, Post.title, Post.text, Post.img,
+                    exists().where(PostBody.id == Post.id).label('archived'),
+                ).where(
+                    Post.id.in_([x.post_id for x in pages]),
+                    Post.url.is_not(None),
+                    or_(Post.img.is_(None), ~exists().where(PostBody.id == Post.id)),
+                )
+            )
+        }
+        for failure in pages:
+            if failure.post_id not in missing:
+                ERRORS.resolve(failure.url)
+
+        job.total = len(links) + len(missing)
+        job.message = f'{len(links)} items, {len(missing)} pages to retry'
+        logging.info(f'Retrying {job.message}')
+        if links:
+            MultiScraper(links, progress=job.advance).save()
+        found = {}
+        if missing:
+            scraper = MultiScraper({}, progress=job.advance)
+            found = trio.run(scraper.fetch_pages, [(x.id, x.url) for x in missing.values()])
+            save_pages(session, missing, found)
+        ERRORS.flush(session)
+        session.commit()
+        job.message += f', {len(found)} pages read'
+
+        # Posts saved by the retry, and crawls which were cut short
+        submit_comment_crawl(pending_posts(unseeded=True))
+
+
+RETRIES = RetryScheduler()
+
+
+def save_pages(session: Session, posts: Dict[int, Row], pages: Dict[int, PageInfo]):
+    """
+    Fill in what saved posts lack from their pages fetched again
+
+    Args:
+        session (Session): The session writing the posts
+        posts (Dict[int, Row]): The ``id``, ``title``, ``text``, ``img`` and
+            ``archived`` flag of each post
+        pages (Dict[int, PageInfo]): The parsed page of each post id
+    """
+    images = [
+        {'id': k, 'img': v.img} for k, v in pages.items()
+        if v.img is not None and posts[k].img is None
+    ]
+    if images:
+        session.execute(update(Post), images)
+    bodies = [
+        {'id': k, 'codec': v.body[0], 'data': v.body[1]} for k, v in pages.items()
+        if v.body is not None and not posts[k].archived
+    ]
+    if bodies:
+        session.execute(insert(PostBody).on_conflict_do_nothing(), bodies)
+        index_posts(session, [
+            {
+                'id': x['id'],
+                'title': posts[x['id']].title,
+                'text': html_to_text(posts[x['id']].text),
+                'body': pages[x['id']].text,
+            }
+            for x in bodies
+        ])
+    if images or bodies:
+        stats.bump_generation(session)
+
+
+def submit_retries(force: bool = False) -> Optional[Job]:
+    """
+    Queue a retry of the failed urls which are due
+
+    Args:
+        force (bool): Queue it even if a retry ran within ``RETRY_INTERVAL``
+
+    Returns:
+        Optional[Job]: The queued job, None if a retry ran recently
+    """
+    if not force and ran_within(LAST_RETRY, RETRY_INTERVAL):
+        return None
+    return WORKER.submit('retries', RETRIES.run, label='Retrying')
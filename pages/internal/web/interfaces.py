@@ -1,5 +1,41 @@
 from .schema import *
-import asks
+from typing import Any, Callable, Dict
+import threading
 
-DBMi = DBM()
-SESS = s = asks.Session(connections=100)
\ No newline at end of file
+# The shared database manager, http session and scheduler are only built on
+# first use, so importing a module never opens the database or a connection
+# pool. Accessed as ``inter.DBMi``, ``inter.SESS`` and ``inter.SCHED``.
+_LOCK = threading.RLock()
+
+
+def _dbm() -> Any:
+    return DBM()
+
+
+def _session() -> Any:
+    import asks
+    return asks.Session(connections=100)
+
+
+def _scheduler() -> Any:
+    from .client import HostScheduler
+    from .cache import ResponseCache
+    return HostScheduler(cache=ResponseCache())
+
+
+_FACTORIES: Dict[str, Callable[[], Any]] = {
+    'DBMi': _dbm,
+    'SESS': _session,
+    's': lambda: __getattr__('SESS'),
+    'SCHED': _scheduler,
+}
+
+
+def __getattr__(name: str) -> Any:
+    factory = _FACTORIES.get(name)
+    if factory is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _LOCK:
+        if name not in globals():
+            globals()[name] = factory()
+    return globals()[name]
@@ -0,0 +1,256 @@
+from typing import Callable, List, Optional, Tuple
+from sqlalchemy import Connection, Engine, inspect, text
+from .schema import FTS_DDL, compress, decompress
+from .domains import registrable_domain
+from .extract import html_to_text
+import logging
+
+# (version, migration), applied in order. The schema version of a database
+# is kept in ``PRAGMA user_version``. Migrations must be idempotent, as
+# create_all may already have created part of what they add. A migration
+# returns True when it freed enough space to be worth a VACUUM.
+Migration = Callable[[Connection], Optional[bool]]
+MIGRATIONS: List[Tuple[int, Migration]] = []
+
+# db_meta key of the last post id added to the full text index by the
+# backfill, present until the backfill is done
+FTS_BACKFILL = 'fts_backfill'
+
+
+def migration(version: int):
+    """Register a migration bringing the schema to ``version``"""
+    def register(func: Migration):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda x: x[0])
+        return func
+    return register
+
+
+def columns(conn: Connection, table: str) -> List[str]:
+    return [x['name'] for x in inspect(conn).get_columns(table)]
+
+
+@migration(1)
+def move_html_bodies(conn: Connection, batch_size: int = 500):
+    """Move the html column of ``hn_bookmarks`` into compressed ``post_bodies``"""
+    if 'html' not in columns(conn, 'hn_bookmarks'):
+        return
+
+    rows = conn.execute(text(
+        'SELECT id, html FROM hn_bookmarks WHERE html IS NOT NULL'
+    ))
+    while batch := rows.fetchmany(batch_size):
+        bodies = []
+        for post_id, html in batch:
+            codec, data = compress(html)
+            bodies.append({'id': post_id, 'codec': codec, 'data': data})
+        conn.execute(
+            text('INSERT OR REPLACE INTO post_bodies (id, codec, data) VALUES (:id, :codec, :data)'),
+            bodies
+        )
+    conn.execute(text('ALTER TABLE hn_bookmarks DROP COLUMN html'))
+    return True
+
+
+@migration(2)
+def add_post_indexes(conn: Connection):
+    """Index the columns the views filter and sort on"""
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_date_added ON hn_bookmarks (date_added, id)'
+    ))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_url ON hn_bookmarks (url)'
+    ))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_img_missing ON hn_bookmarks (id) WHERE img IS NULL'
+    ))
+
+
+@migration(3)
+def add_post_domains(conn: Connection, batch_size: int = 1000):
+    """Add and backfill the registrable domain of each post"""
+    if 'domain' not in columns(conn, 'hn_bookmarks'):
+        conn.execute(text('ALTER TABLE hn_bookmarks ADD COLUMN domain VARCHAR'))
+
+    rows = conn.execute(text(
+        'SELECT id, url FROM hn_bookmarks WHERE url IS NOT NULL AND domain IS NULL'
+    )).all()
+    for x in range(0, len(rows), batch_size):
+        conn.execute(
+            text('UPDATE hn_bookmarks SET domain = :domain WHERE id = :id'),
+            [
+                {'id': post_id, 'domain': registrable_domain(url)}
+                for post_id, url in rows[x:x + batch_size]
+            ]
+        )
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_domain ON hn_bookmarks (domain, descendants)'
+    ))
+
+
+@migration(4)
+def add_full_text_index(conn: Connection):
+    """
+    Create the full text index of the posts
+
+    Filling it means decompressing and parsing every archived article, so
+    that is left to ``fill_full_text_index``, in batches of their own.
+    """
+    conn.execute(text(FTS_DDL))
+    conn.execute(
+        text('INSERT OR IGNORE INTO db_meta (key, value) VALUES (:key, 0)'),
+        {'key': FTS_BACKFILL}
+    )
+
+
+def fill_full_text_index(engine: Engine, batch_size: int = 200):
+    """
+    Add the posts saved before the full text index existed to it
+
+    Every batch commits along with the id it reached, so an interrupted
+    backfill resumes where it stopped.
+
+    Args:
+        engine (Engine): The engine of the database
+        batch_size (int): The number of posts indexed per transaction
+    """
+    with engine.connect() as conn:
+        last = conn.execute(
+            text('SELECT value FROM db_meta WHERE key = :key'), {'key': FTS_BACKFILL}
+        ).scalar()
+        if last is None:
+            return
+        total = conn.execute(
+            text('SELECT COUNT(*) FROM hn_bookmarks WHERE id > :last'), {'last': last}
+        ).scalar_one()
+
+    done = 0
+    while True:
+        with engine.begin() as conn:
+            batch = conn.execute(
+                text(
+                    'SELECT p.id, p.title, p.text, b.codec, b.data FROM hn_bookmarks p '
+                    'LEFT JOIN post_bodies b ON b.id = p.id '
+                    'WHERE p.id > :last ORDER BY p.id LIMIT :limit'
+                ),
+                {'last': last, 'limit': batch_size}
+            ).all()
+            if not batch:
+                conn.execute(text('DELETE FROM db_meta WHERE key = :key'), {'key': FTS_BACKFILL})
+                break
+            conn.execute(
+                text(
+                    'INSERT OR REPLACE INTO posts_fts (rowid, title, text, body) '
+                    'VALUES (:id, :title, :text, :body)'
+                ),
+                [
+                    {
+                        'id': post_id,
+                        'title': title,
+                        'text': html_to_text(post_text),
+                        'body': html_to_text(decompress(codec, data)) if data else None,
+                    }
+                    for post_id, title, post_text, codec, data in batch
+                ]
+            )
+            last = batch[-1][0]
+            conn.execute(
+                text('UPDATE db_meta SET value = :last WHERE key = :key'),
+                {'last': last, 'key': FTS_BACKFILL}
+            )
+        done += len(batch)
+        print(f"Indexed {done}/{total} posts for search")
+
+
+@migration(5)
+def add_image_checks(conn: Connection):
+    """Track when and how each post image was last validated"""
+    existing = columns(conn, 'hn_bookmarks')
+    for column, kind in (('img_checked', 'DATETIME'), ('img_status', 'VARCHAR')):
+        if column not in existing:
+            conn.execute(text(f'ALTER TABLE hn_bookmarks ADD COLUMN {column} {kind}'))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_img_checked ON hn_bookmarks (img_checked) '
+        'WHERE img IS NOT NULL'
+    ))
+
+
+@migration(6)
+def count_url_failures(conn: Connection):
+    """Fold the ``post_errors`` log into one ``url_failures`` counter per url"""
+    if not inspect(conn).has_table('post_errors'):
+        return
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS url_failures ('
+        'url VARCHAR NOT NULL PRIMARY KEY, type VARCHAR NOT NULL, '
+        'description VARCHAR NOT NULL, count INTEGER NOT NULL, '
+        'first_failed DATETIME NOT NULL, last_failed DATETIME NOT NULL, '
+        'next_retry DATETIME, post_id INTEGER, date_added DATETIME)'
+    ))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_url_failures_next_retry ON url_failures (next_retry)'
+    ))
+    # The old log has no post ids, so these urls are not retried
+    conn.execute(text(
+        'INSERT OR REPLACE INTO url_failures '
+        '(url, type, description, count, first_failed, last_failed) '
+        'SELECT url, type, description, COUNT(*), MIN(time), MAX(time) '
+        'FROM post_errors GROUP BY url'
+    ))
+    conn.execute(text('DROP TABLE post_errors'))
+
+
+@migration(7)
+def add_post_refreshes(conn: Connection):
+    """Track when the score and descendants of each post were last refreshed"""
+    if 'refreshed' not in columns(conn, 'hn_bookmarks'):
+        conn.execute(text('ALTER TABLE hn_bookmarks ADD COLUMN refreshed DATETIME'))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_hn_bookmarks_time ON hn_bookmarks (time)'
+    ))
+
+
+def latest() -> int:
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def migrate(engine: Engine, fresh: bool = False):
+    """
+    Bring the schema of a database up to date in place
+
+    Every pending migration runs in its own transaction, together with the
+    bump of the schema version. Then any backfill of the full text index
+    runs, and the database is vacuumed if a migration freed space.
+
+    Args:
+        engine (Engine): The engine of the database
+        fresh (bool): The database was just created with the latest schema
+    """
+    with engine.connect() as conn:
+        version = conn.execute(text('PRAGMA user_version')).scalar_one()
+
+    if fresh:
+        version = latest()
+        with engine.begin() as conn:
+            conn.execute(text(f'PRAGMA user_version = {version}'))
+        return
+
+    pending = [x for x in MIGRATIONS if x[0] > version]
+    vacuum = False
+    for target, func in pending:
+        logging.info(f'Migrating database to version {target}: {func.__name__}')
+        with engine.begin() as conn:
+            vacuum |= bool(func(conn))
+            conn.execute(text(f'PRAGMA user_version = {target}'))
+
+    fill_full_text_index(engine)
+
+    if pending:
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            if vacuum:
+                # Reclaim the space freed by the migrations
+                logging.info('Vacuuming database')
+                conn.execute(text('VACUUM'))
+            # Refresh the statistics of the new columns and indexes
+            conn.execute(text('ANALYZE'))
@@ -0,0 +1,180 @@
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select
+from sqlalchemy.dialects.sqlite import insert
+from .schema import Meta, Post
+from .failures import ERRORS, ErrorType
+from . import interfaces as inter
+from . import scraper
+import logging
+import json
+import trio
+
+# The fields of a post which change after it is submitted
+MUTABLE_FIELDS = ('score', 'descendants')
+
+# (age, interval): posts younger than ``age`` are refreshed every ``interval``.
+# The newest posts change the most, and HN locks voting and comments after
+# two weeks, so older posts are only refreshed when listed in updates.json.
+REFRESH_POLICY: List[Tuple[timedelta, timedelta]] = [
+    (timedelta(days=1), timedelta(minutes=30)),
+    (timedelta(days=3), timedelta(hours=3)),
+    (timedelta(days=14), timedelta(days=1)),
+]
+
+MAXITEM = 'refresh_maxitem'
+
+
+class PostRefresher:
+    """
+    Incremental refresh of the score and descendants of the bookmarks.
+
+    A run first reads ``updates.json`` and ``maxitem.json``. Bookmarks
+    listed as recently changed are always refreshed. When ``maxitem`` moved
+    since the last run, bookmarks due under the ``REFRESH_POLICY`` are
+    refreshed as well, newest first, up to ``budget`` items per run. Only
+    the mutable fields are written back, with batched executemany updates.
+
+    Args:
+        policy (Optional[List[Tuple[timedelta, timedelta]]]): The refresh interval by post age
+        budget (int): The most scheduled refreshes per run
+        workers (int): The number of concurrent requests
+        progress (Optional[Callable[[], None]]): Called after every refreshed item
+    """
+    def __init__(
+        self,
+        policy: Optional[List[Tuple[timedelta, timedelta]]] = None,
+        budget: int = 500,
+        workers: int = 32,
+        progress: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.policy = REFRESH_POLICY if policy is None else policy
+        self.budget = budget
+        self.workers = workers
+        self.progress = progress
+        self.n_refreshed = 0
+        self.maxitem: Optional[int] = None
+
+    async def get_json(self, url: str) -> Any:
+        # Never from the response cache, these are the live values
+        resp = await inter.SCHED.get(inter.SESS, url, timeout=10)
+        if resp.status_code != 200:
+            raise ValueError(f'{url} returned {resp.status_code}')
+        return json.loads(resp.content.decode('utf-8', errors='ignore'))
+
+    async def changes(self) -> Tuple[Optional[int], Set[int]]:
+        """
+        Get the newest item id and the recently changed items
+
+        Returns:
+            Tuple[Optional[int], Set[int]]: ``maxitem`` and the items of ``updates.json``
+        """
+        output: Dict[str, Any] = {}
+
+        async def get(key: str, url: str):
+            try:
+                output[key] = await self.get_json(url)
+            except* Exception as e:
+                logging.warning(f"Unable to get {url} due to {e.__class__}")
+
+        async with trio.open_nursery() as n:
+            n.start_soon(get, 'maxitem', f'{scraper.API_BASE}/maxitem.json')
+            n.start_soon(get, 'updates', f'{scraper.API_BASE}/updates.json')
+        updates = output.get('updates') or {}
+        return output.get('maxitem'), set(updates.get('items', []))
+
+    def due(self, updated: Set[int], maxitem: Optional[int], now: datetime) -> List[int]:
+        """
+        Get the ids of the bookmarks to refresh, in priority order
+
+        Args:
+            updated (Set[int]): The items HN lists as recently changed
+            maxitem (Optional[int]): The newest item id, None if unknown
+            now (datetime): The time of the run
+        """
+        session = inter.DBMi.session
+        output = list(session.scalars(
+            select(Post.id).where(Post.id.in_(updated)).order_by(Post.time.desc())
+        )) if updated else []
+
+        last = session.scalar(select(Meta.value).where(Meta.key == MAXITEM))
+        if maxitem is not None and maxitem == last:
+            # No new items, so no new comments either
+            return output
+
+        seen = set(output)
+        n_updated = len(output)
+        for age, interval in self.policy:
+            remaining = self.budget - (len(output) - n_updated)
+            if remaining <= 0:
+                break
+            ids = session.scalars(
+                select(Post.id)
+                .where(
+                    Post.time >= now - age,
+                    or_(Post.refreshed.is_(None), Post.refreshed < now - interval),
+                    Post.id.not_in(seen),
+                )
+                .order_by(Post.time.desc())
+                .limit(remaining)
+            ).all()
+            output.extend(ids)
+            seen.update(ids)
+        return output
+
+    async def fetch(self, post_ids: List[int], now: datetime) -> List[Dict[str, Any]]:
+        """Get the mutable fields of the posts"""
+        rows = []
+        limiter = trio.CapacityLimiter(self.workers)
+
+        async def fetch(post_id: int):
+            url = scraper.item_url(post_id)
+            err = None
+            try:
+                async with limiter:
+                    item = await self.get_json(url)
+                row = {'id': post_id, 'refreshed': now}
+                if item and not item.get('dead') and not item.get('deleted'):
+                    row.update({k: item[k] for k in MUTABLE_FIELDS if k in item})
+                rows.append(row)
+            except* Exception as e:
+                err = (ErrorType.url, str(e.__class__))
+            if err is not None:
+                ERRORS.record(url, *err)
+            if self.progress is not None:
+                self.progress()
+
+        async with trio.open_nursery() as n:
+            for post_id in post_ids:
+                n.start_soon(fetch, post_id)
+        return rows
+
+    async def refresh(self) -> List[Dict[str, Any]]:
+        now = datetime.now()
+        maxitem, updated = await self.changes()
+        post_ids = self.due(updated, maxitem, now)
+        logging.info(f"Refreshing {len(post_ids)} posts, {len(updated)} items changed on HN")
+        rows = await self.fetch(post_ids, now)
+        self.maxitem = maxitem
+        return rows
+
+    def run(self) -> int:
+        """
+        Refresh the bookmarks which changed or are due
+
+        Returns:
+            int: The number of refreshed posts
+        """
+        rows = trio.run(self.refresh)
+        session = inter.DBMi.session
+        if self.maxitem is not None:
+            stmnt = insert(Meta).values(key=MAXITEM, value=self.maxitem)
+            session.execute(stmnt.on_conflict_do_update(
+                index_elements=[Meta.key], set_={'value': stmnt.excluded.value}
+            ))
+        ERRORS.flush(session)
+        # Commits the watermark and failures too
+        scraper.update_posts(rows)
+        session.commit()
+        self.n_refreshed = len(rows)
+        return self.n_refreshed
@@ -1,8 +1,9 @@
 from __future__ import annotations
 
-from sqlalchemy import Column, ForeignKey, create_engine, Table
-from sqlalchemy_utils import database_exists, create_database
+from sqlalchemy import DDL, Column, ForeignKey, Index, create_engine, event, Table, inspect
 from sqlalchemy.orm import (
+    Session,
+    scoped_session,
     sessionmaker,
     relationship,
     DeclarativeBase,
@@ -13,9 +14,28 @@ from sqlalchemy.orm import (
 from appdirs import user_cache_dir
 from pathlib import Path
 from datetime import datetime
+from .codec import compress, decompress
 import logging
+import os
 
-CACHE = f"sqlite:///{user_cache_dir('hn-browser')}/hackernews.db"
+# The database file, replaceable with HN_BROWSER_DB, e.g. for benchmarks
+DB_PATH = Path(os.environ.get('HN_BROWSER_DB', Path(user_cache_dir('hn-browser')) / 'hackernews.db'))
+CACHE = f"sqlite:///{DB_PATH}"
+# The same database through a read-only connection
+READ_CACHE = f"sqlite:///file:{DB_PATH}?mode=ro&uri=true"
+
+# Applied to every new connection
+PRAGMAS = (
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "cache_size = -65536",  # 64 MiB
+    "mmap_size = 268435456",  # 256 MiB
+    "temp_store = MEMORY",
+    "busy_timeout = 5000",
+)
+READ_PRAGMAS = tuple(x for x in PRAGMAS if not x.startswith("journal_mode")) + (
+    "query_only = ON",
+)
 
 # declarative base class
 class Base(DeclarativeBase, MappedAsDataclass):
@@ -49,8 +69,59 @@ class Post(Base):
     url: Mapped[str | None] = mapped_column(default=None)
     text: Mapped[str | None] = mapped_column(default=None)
     img: Mapped[str | None] = mapped_column(default=None)
-    html: Mapped[str | None] = mapped_column(default=None)
-    
+    domain: Mapped[str | None] = mapped_column(default=None)
+    img_checked: Mapped[datetime | None] = mapped_column(default=None)
+    img_status: Mapped[str | None] = mapped_column(default=None)
+    refreshed: Mapped[datetime | None] = mapped_column(default=None)
+    body: Mapped[PostBody | None] = relationship(
+        default=None, lazy='select', cascade='all, delete-orphan', repr=False
+    )
+
+    @property
+    def html(self) -> str | None:
+        """The archived article html, decompressed on access"""
+        return self.body.html if self.body is not None else None
+
+    @html.setter
+    def html(self, value: str | None):
+        self.body = PostBody.from_html(value) if value is not None else None
+
+
+# Indexes on the columns the views filter and sort on
+Index("ix_hn_bookmarks_date_added", Post.date_added, Post.id)
+Index("ix_hn_bookmarks_url", Post.url)
+Index("ix_hn_bookmarks_img_missing", Post.id, sqlite_where=Post.img.is_(None))
+Index("ix_hn_bookmarks_domain", Post.domain, Post.descendants)
+Index("ix_hn_bookmarks_time", Post.time)
+Index("ix_hn_bookmarks_img_checked", Post.img_checked, sqlite_where=Post.img.is_not(None))
+
+# Full text index over titles, post text and archived articles, keyed on
+# the post id as rowid. Created along with hn_bookmarks on new databases.
+FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5("
+    "title, text, body, tokenize = 'porter unicode61')"
+)
+event.listen(Post.__table__, "after_create", DDL(FTS_DDL))
+
+
+class PostBody(Base):
+    """Compressed article html, kept out of ``hn_bookmarks`` and loaded lazily"""
+    __tablename__ = "post_bodies"
+
+    id: Mapped[int] = mapped_column(
+        ForeignKey("hn_bookmarks.id"), primary_key=True, init=False
+    )
+    codec: Mapped[str]
+    data: Mapped[bytes] = mapped_column(repr=False)
+
+    @classmethod
+    def from_html(cls, html: str) -> PostBody:
+        codec, data = compress(html)
+        return cls(codec=codec, data=data)
+
+    @property
+    def html(self) -> str:
+        return decompress(self.codec, self.data)
 
 
 class Child(Base):
@@ -60,28 +131,80 @@ class Child(Base):
     child: Mapped[str] = mapped_column(primary_key=True)
 
 
+class Comment(Base):
+    """
+    A comment of a post, pointing at its parent to form the thread.
+
+    Rows are inserted unfetched as soon as their parent lists them, which
+    is the frontier a crawl resumes from.
+    """
+    __tablename__ = "hn_comments"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    post_id: Mapped[int]
+    parent: Mapped[int] = mapped_column(index=True)
+    depth: Mapped[int]
+    fetched: Mapped[bool] = mapped_column(default=False)
+    author: Mapped[str | None] = mapped_column(default=None)
+    time: Mapped[datetime | None] = mapped_column(default=None)
+    text: Mapped[str | None] = mapped_column(default=None, repr=False)
+    deleted: Mapped[bool] = mapped_column(default=False)
+    dead: Mapped[bool] = mapped_column(default=False)
+
+
+# Threads are read by post in depth order, the frontier by depth
+Index("ix_hn_comments_post", Comment.post_id, Comment.depth)
+Index("ix_hn_comments_pending", Comment.depth, Comment.id, sqlite_where=Comment.fetched.is_(False))
+
+
 class Tag(Base):
     __tablename__ = "tags"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     description: Mapped[str]
 
-class Error(Base):
-    __tablename__ = "post_errors"
+class Failure(Base):
+    """Failure counter of a scraped url, and when to retry it"""
+    __tablename__ = "url_failures"
 
     url: Mapped[str] = mapped_column(primary_key=True)
-    type: Mapped[str] = mapped_column(primary_key=True)
-    time: Mapped[datetime] = mapped_column(primary_key=True)
+    type: Mapped[str]
     description: Mapped[str]
+    count: Mapped[int]
+    first_failed: Mapped[datetime]
+    last_failed: Mapped[datetime]
+    next_retry: Mapped[datetime | None] = mapped_column(default=None, index=True)
+    post_id: Mapped[int | None] = mapped_column(default=None)
+    date_added: Mapped[datetime | None] = mapped_column(default=None)
+
+class BookmarkState(Base):
+    """Watermark of the last bookmarks file that was fully synced"""
+    __tablename__ = "bookmark_state"
+
+    path: Mapped[str] = mapped_column(primary_key=True)
+    size: Mapped[int]
+    mtime_ns: Mapped[int]
+    offset: Mapped[int]
+    digest: Mapped[str]
+
+class Meta(Base):
+    """Database wide counters, such as the write generation"""
+    __tablename__ = "db_meta"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    value: Mapped[int]
 
 class DBM:
-    def __init__(self) -> None:
+    def __init__(self, pool_size: int = 8) -> None:
+        # Slow to import and only needed here
+        from sqlalchemy_utils import database_exists, create_database
+
         # Check if DB exists. Create if not
         if database_exists(CACHE):
             print("DB exists")
             print(CACHE)
         else:
-            Path(user_cache_dir("hn-browser")).mkdir(parents=True, exist_ok=True)
+            DB_PATH.parent.mkdir(parents=True, exist_ok=True)
             print("Creating DB")
             create_database(CACHE)
 
@@ -98,7 +221,55 @@ class DBM:
         logging.info(f'DB location: {CACHE}')
 
         self.engine = create_engine(CACHE, echo=False) # type: ignore
+        event.listen(self.engine, "connect", set_pragmas)
+
+        # Imported here as the migrations depend on this module
+        from .migrations import migrate
+        fresh = not inspect(self.engine).has_table(Post.__tablename__)
         Base.metadata.create_all(self.engine)
+        migrate(self.engine, fresh)
+
+        # Pooled read-only connections for the views, so concurrent requests
+        # never queue behind a write
+        self.read_engine = create_engine(
+            READ_CACHE, echo=False, pool_size=pool_size, max_overflow=2 * pool_size
+        )
+        event.listen(self.read_engine, "connect", set_read_pragmas)
+
+        # One session per thread, e.g. per Flask request or the ingest worker
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.Reader = scoped_session(sessionmaker(bind=self.read_engine))
+
+    @property
+    def session(self) -> Session:
+        """The read-write session of the current thread"""
+        return self.Session()
+
+    @property
+    def reader(self) -> Session:
+        """The read-only session of the current thread"""
+        return self.Reader()
+
+    def remove(self):
+        """Close the sessions of the current thread, e.g. at the end of a request"""
+        self.Session.remove()
+        self.Reader.remove()
+
+    def dispose(self):
+        """Drop the connections inherited from the parent, in a forked process"""
+        self.engine.dispose(close=False)
+        self.read_engine.dispose(close=False)
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        self.Reader = scoped_session(sessionmaker(bind=self.read_engine))
+
+
+def set_pragmas(dbapi_connection, connection_record, pragmas=PRAGMAS):
+    """Apply the SQLite performance profile to a new connection"""
+    cursor = dbapi_connection.cursor()
+    for pragma in pragmas:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
 
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+def set_read_pragmas(dbapi_connection, connection_record):
+    set_pragmas(dbapi_connection, connection_record, READ_PRAGMAS)
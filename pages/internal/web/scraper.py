@@ -1,138 +1,188 @@
-from bs4 import BeautifulSoup as sp
-from typing import List, Dict, Tuple, TypeAlias, Optional
+from typing import TYPE_CHECKING, Any, Callable, List, Dict, Tuple, TypeAlias, Optional
 import json
-from .schema import Child, Post, Error
+from .schema import Child, Post, PostBody
+from .failures import ERRORS, ErrorType
+from .cache import RequestKind
+from .domains import registrable_domain
+from .extract import ImageProbe, PageInfo, analyze_page, html_to_text, run_in_pool
+from .search import index_posts
+from .throughput import Throughput
 from . import interfaces as inter
-from urllib.parse import urljoin, quote_plus
+from . import stats
+from urllib.parse import quote_plus
 from datetime import datetime
-from sqlalchemy import update, insert
+from sqlalchemy import update
+from sqlalchemy.orm import Session
 import logging
+import os
 from enum import Enum
-from requests import Response
-import numpy as np
 import trio
 import asks
 import re
 
-class ErrorType(Enum):
-    """
-    Scraping Error Types
-    """
-    url = 'url'
-    img = 'image'
-    bing = 'bing image'
-    resp = 'no response'
+if TYPE_CHECKING:
+    # Only for annotations, requests is slow to import
+    from requests import Response
+
+# The Hacker News api, replaceable by a local stand-in with HN_API_BASE
+API_BASE = os.environ.get('HN_API_BASE', "https://hacker-news.firebaseio.com/v0").rstrip('/')
+
+
+def configure_api(base: str):
+    global API_BASE
+    API_BASE = base.rstrip('/')
+
+
+def item_url(item_id: int) -> str:
+    """The api url of an item (story, comment, ...)"""
+    return f"{API_BASE}/item/{item_id}.json"
+
+
+# The id of a post from its Firebase item url
+ITEM_ID = re.compile(r'/item/(\d+)\.json')
+
+
+def item_id(url: str) -> Optional[int]:
+    match = ITEM_ID.search(url)
+    return int(match.group(1)) if match else None
 
 AsyncAPIData: TypeAlias = Tuple[
     Optional[Post], 
-    Optional[List[Child]]
+    Optional[List[Child]],
+    Optional[str],
 ]
 
 
 class MultiScraper:
+    """
+    Scrape bookmarked posts through a streaming pipeline.
+
+    Links flow through bounded trio memory channels from the api fetchers,
+    to the image extractors, to a single writer which commits every
+    ``batch_size`` posts. Only a bounded number of posts are in flight at a
+    time, so memory stays flat regardless of the backlog. Committed batches
+    act as the checkpoint: an interrupted run only leaves the unsaved posts
+    to be found by the next bookmark diff.
+
+    The ``links`` map each post id to the date it was bookmarked and its
+    item url. A ``throughput`` collects the items, bytes and errors of the
+    ``item``, ``page``, ``parse`` and ``save`` stages. A ``dry_run`` scrapes
+    as usual but writes nothing to the database.
+    """
     def __init__(
-        self, links: Dict[datetime, str], silent: bool = False, verbose: bool = False
+        self, links: Dict[int, Tuple[datetime, str]], silent: bool = False, verbose: bool = False,
+        progress: Optional[Callable[[], None]] = None,
+        workers: int = 32,
+        batch_size: int = 50,
+        throughput: Optional[Throughput] = None,
+        dry_run: bool = False,
     ) -> None:
-        self.links: Dict[datetime, str] = links
+        self.links: Dict[int, Tuple[datetime, str]] = links
         self.silent: bool = silent
         self.verbose = verbose
+        self.progress = progress
+        self.workers = workers
+        self.batch_size = batch_size
+        self.throughput = throughput
+        self.dry_run = dry_run
 
-        posts = trio.run(self.get_all)
-
-        self.children: List[Child] = []
-        self.posts: List[Post] = []
-
-        for (post, child) in posts:
-            if post is not None:
-                self.posts.append(post)
-            if child is not None:
-                self.children += child
-
+        self.n_posts = 0
+        self.n_children = 0
 
-        if self.verbose and (not self.silent):
-            logging.debug("Pages:")
-            for page in self.posts:
-                logging.debug(page)
+    def record(self, stage: str, n_bytes: int = 0, error: bool = False, items: int = 1):
+        if self.throughput is not None:
+            self.throughput.record(stage, n_bytes, error, items)
 
-            logging.debug("Children:")
-            for child in self.children:
-                logging.debug(child)
-
-    async def get_image(
+    async def get_page_info(
         self, url: Optional[str], 
+        html: Optional[str],
         session: asks.Session,
-        output: List[Optional[str]],
-        ind: int
-    ):
+        post_id: Optional[int] = None,
+        archive: bool = False,
+    ) -> Optional[PageInfo]:
         """
-        Get the image from the url
+        Get the image, metadata and text of the page at the url
+
+        The page is only downloaded when its html was not already fetched,
+        and only until its image turns up unless it is to be archived.
+        Parsing happens in the parse pool, so large pages do not stall the
+        other requests in flight.
 
         Args:
             url (Optional[str]): The url to get the image from
-            session (asks.Session): The session to use to get the image
-            output (List[Optional[str]]): The output list to store the image
-            ind (int): The index of the url in the list
+            html (Optional[str]): The already fetched html of the url
+            session (asks.Session): The session to use to get the page
+            post_id (Optional[int]): The post linking to the url, to retry failures
+            archive (bool): Also compress the html in the parse pool, see ``PageInfo.body``
+
+        Returns:
+            Optional[PageInfo]: The parsed page, if it could be read
         """
         err = None
-        img = None
+        info = None
+        stage = 'page'
         if url is not None:
             try:
-                resp: Response = await session.get(url, timeout=10)
-                content = resp.content.decode("utf-8")
-                if resp.reason_phrase=='OK': # type: ignore
-                    soup = sp(content, "html.parser")
-                    images = soup.findAll("img")
-                    if len(images):
-                        if not self.silent:
-                            mess = "Successfully got image from {} of length {}."
-                            logging.info(mess.format(url, resp.__sizeof__()))
-                        img = images[0].attrs["src"]
-                        if not img.startswith("data:image"):
-                            img = urljoin(url, img)
+                if html is None:
+                    # Only read the page until its image turns up
+                    resp: Response = await inter.SCHED.fetch_page(
+                        session, url, stop=None if archive else ImageProbe().feed, timeout=10
+                    )
+                    if resp.reason_phrase=='OK': # type: ignore
+                        html = resp.content.decode("utf-8", errors='ignore') or None
                     else:
-                        if not self.silent:
+                        logging.warning(f"Unable to get image from {url}. No response.")
+                        err = (ErrorType.resp, 'no response')
+                    self.record('page', len(resp.content or b''), err is not None)
+                if html is not None:
+                    stage = 'parse'
+                    info = await run_in_pool(analyze_page, url, html, 100_000, archive)
+                    self.record('parse', len(html))
+                    if not self.silent:
+                        if info.img is None:
                             logging.info("No images found at {}".format(url))
-                else:
-                    logging.warning(f"Unable to get image from {url}. No response.")
-                    err = Error(
-                        url=url, type=ErrorType.resp.value, 
-                        time=datetime.now(), description='no response'
-                    )
+                        else:
+                            mess = "Successfully got image from {} of length {}."
+                            logging.info(mess.format(url, len(html)))
             except* Exception as e:
                 logging.warning("Unable to get image from {} due to {}.".format(
                         url, 
                         e.__class__
                     )
                 )
-                err = Error(
-                    url=url, type=ErrorType.img.value, 
-                    time=datetime.now(), description=str(e.__class__)
-                )
+                err = (ErrorType.img, str(e.__class__))
+                self.record(stage, error=True)
             if err is not None:
-                inter.DBMi.session.execute(insert(Error), [err.to_dict()])
-            output[ind] = img
+                ERRORS.record(url, *err, post_id=post_id)
+            elif info is not None:
+                ERRORS.resolve(url)
+        return info
 
     async def get_api_data(
         self, record: Tuple[datetime, str], 
         session: asks.Session,
-        output: List[AsyncAPIData],
-        ind: int
-    ):
+    ) -> AsyncAPIData:
         """
         Get the api data from the url
 
         Args:
             record (Tuple[datetime, str]): The record to get the api data from
             session (asks.Session): The session to use to get the api data
-            output (List[AsyncAPIData]): The output list to store the api data
-            ind (int): The index of the record in the list
+
+        Returns:
+            AsyncAPIData: The post, its children and its article html, if the post could be scraped
         """
         time, url = record
         post = None
         children = None
+        html = None
         err = None
+        n_bytes = 0
         try:
-            resp: Response = await session.get(url, timeout=10)
+            resp: Response = await inter.SCHED.get(
+                session, url, kind=RequestKind.item, timeout=10
+            )
+            n_bytes = len(resp.content)
             content = resp.content.decode("utf-8", errors='ignore')
             if len(content) and "Sorry" not in content:
                 if not self.silent:
@@ -148,17 +198,31 @@ class MultiScraper:
                 resp_dec["time"] = datetime.fromtimestamp(resp_dec.pop("time"))
                 resp_dec["date_added"] = time
                 resp_dec['tags'] = []
+                resp_dec['domain'] = registrable_domain(resp_dec.get('url'))
 
                 # Get HTML content if URL exists
                 if "url" in resp_dec and resp_dec["url"]:
                     try:
-                        html_resp = await session.get(resp_dec["url"], timeout=10)
-                        if html_resp.reason_phrase == 'OK':
+                        html_resp = await inter.SCHED.fetch_page(
+                            session, resp_dec["url"], timeout=10
+                        )
+                        ok = html_resp.reason_phrase == 'OK'
+                        if ok and html_resp.content:
                             resp_dec['html'] = html_resp.content.decode("utf-8", errors='ignore')
                             if not self.silent:
                                 logging.info(f"Successfully got HTML for {resp_dec['url']}")
+                        elif not ok:
+                            # Left to the retry scheduler rather than fetched again now
+                            ERRORS.record(
+                                resp_dec['url'], ErrorType.resp, 'no response', post_id=resp_dec['id']
+                            )
+                        self.record('page', len(html_resp.content or b''), not ok)
                     except* Exception as e:
                         logging.warning(f"Failed to get HTML for {resp_dec['url']}: {str(e)}")
+                        ERRORS.record(
+                            resp_dec['url'], ErrorType.img, str(e.__class__), post_id=resp_dec['id']
+                        )
+                        self.record('page', error=True)
 
                 # Construct Objects
                 if "kids" in resp_dec.keys():
@@ -168,89 +232,227 @@ class MultiScraper:
                     ]
                 # Remove dead posts
                 if "dead" in resp_dec.keys():
-                    return
-                post = Post(**resp_dec)
-                if (not self.silent) and self.verbose:
-                    print(post)
+                    children = None
+                else:
+                    # Compressed later, in the parse pool
+                    html = resp_dec.pop('html', None)
+                    post = Post(**resp_dec)
+                    if (not self.silent) and self.verbose:
+                        print(post)
             else:
                 print(f"Unable to get url {url}. No response")
-                err = Error(
-                    url=url, type=ErrorType.resp.value, 
-                    time=datetime.now(), description='no response'
-                )
+                err = (ErrorType.resp, 'no response')
         except* Exception as e:
             print("Unable to get url {} due to {}.".format(url, e.__class__))
-            err = Error(
-                url=url, type=ErrorType.url.value, 
-                time=datetime.now(), description=str(e.__class__)
-            )
+            err = (ErrorType.url, str(e.__class__))
 
+        self.record('item', n_bytes, err is not None)
         if err is not None:
-            inter.DBMi.session.execute(insert(Error), [err.to_dict()])
-        output[ind] = (post, children)
-
-    async def get_all(self) -> List[AsyncAPIData]:
+            ERRORS.record(url, *err, post_id=item_id(url), date_added=time)
+        else:
+            ERRORS.resolve(url)
+        return (post, children, html)
+
+    async def fetch_worker(
+        self,
+        receive: trio.MemoryReceiveChannel,
+        send: trio.MemorySendChannel,
+    ):
+        """
+        Fetch the api data (and article html) of the incoming links
+        """
+        async with receive, send:
+            async for record in receive:
+                post, children, html = await self.get_api_data(record, inter.SESS)
+                if self.progress is not None:
+                    self.progress()
+                if post is not None:
+                    await send.send((post, children, html))
+
+    async def image_worker(
+        self,
+        receive: trio.MemoryReceiveChannel,
+        send: trio.MemorySendChannel,
+    ):
+        """
+        Find the image and the searchable text of the incoming posts, and
+        compress their html for the archive
         """
-        Get all the api data from the urls
+        async with receive, send:
+            async for post, children, html in receive:
+                # The page was already fetched with the item, a failure of
+                # which is retried later, so it is never downloaded twice
+                info = await self.get_page_info(
+                    post.url, html, inter.SESS, post.id, archive=True
+                ) if html is not None else None
+                post.img = info.img if info is not None else None
+                if info is not None and info.body is not None:
+                    post.body = PostBody(*info.body)
+                document = {
+                    'id': post.id,
+                    'title': post.title,
+                    'text': html_to_text(post.text),
+                    'body': info.text if info is not None else None,
+                }
+                await send.send((post, children, document))
+
+    def commit(
+        self, session: Session, posts: List[Post], children: List[Child], documents: List[Dict]
+    ):
+        """
+        Save a batch of posts, children and their search documents to the database
 
-        Returns:
-            List[AsyncAPIData]: The list of api data
+        Blocks on the database, so ``persist`` runs it in a worker thread.
         """
-        posts: List[AsyncAPIData] = [(None,None)] * len(self.links)
-        async with trio.open_nursery() as n:
-            for ind, record in enumerate(self.links.items()):
-                n.start_soon(self.get_api_data, record, inter.SESS, posts, ind)
+        self.record(
+            'save', sum(len(x.body.data) for x in posts if x.body is not None),
+            items=len(posts),
+        )
+        if self.dry_run:
+            self.n_posts += len(posts)
+            self.n_children += len(children)
+            return
 
-        print("Scraping links for images")
-        images: List[Optional[str]] = [None] * len(posts)
-        async with trio.open_nursery() as n:
-            for ind, api_resp in enumerate(posts):
-                if api_resp[0] is not None:
-                    n.start_soon(self.get_image, api_resp[0].url, inter.SESS, images, ind)
+        # Add new bookmarks
+        session.add_all(posts)
+
+        # Add new children
+        session.add_all(children)
+
+        # Index the new bookmarks for search
+        index_posts(session, documents)
+
+        # Record the failures of the batch
+        ERRORS.flush(session)
 
-        for record, image in zip(posts, images):
-            if record[0] is not None:
-                record[0].img = image
+        # Commit changes
+        stats.bump_generation(session)
+        session.commit()
+
+        self.n_posts += len(posts)
+        self.n_children += len(children)
         if not self.silent:
-            print(f"Finalized all. Got {len(posts)} new bookmarks.")
+            print(f"Saved {self.n_posts}/{len(self.links)} posts")
+        if self.verbose:
+            for post in posts:
+                logging.debug(post)
 
-        inter.DBMi.session.commit()
-        return posts
+    async def persist(self, receive: trio.MemoryReceiveChannel):
+        """
+        Commit the incoming posts in batches of ``batch_size``
 
-    def save(self):
+        The commits run in worker threads, so the fetches carry on meanwhile.
+        Worker threads each have their own scoped session, so the batches
+        share one session of their own instead.
         """
-        Save the posts and children to the database
+        posts: List[Post] = []
+        children: List[Child] = []
+        documents: List[Dict] = []
+        with inter.DBMi.Session.session_factory() as session:
+            async with receive:
+                async for post, child, document in receive:
+                    posts.append(post)
+                    documents.append(document)
+                    if child is not None:
+                        children += child
+                    if len(posts) >= self.batch_size:
+                        await trio.to_thread.run_sync(
+                            self.commit, session, posts, children, documents
+                        )
+                        posts, children, documents = [], [], []
+            if posts:
+                await trio.to_thread.run_sync(self.commit, session, posts, children, documents)
+            elif not self.dry_run:
+                # Nothing left to save, but the last links may still have failed
+                await trio.to_thread.run_sync(self.flush_errors, session)
+
+    @staticmethod
+    def flush_errors(session: Session):
         """
-        if len(self.posts):
-            print("Saving DB")
+        Save the recorded failures on their own
+        """
+        ERRORS.flush(session)
+        session.commit()
+
+    async def get_all(self):
+        """
+        Run the fetch -> image -> persist pipeline over all the links
+        """
+        send_links, receive_links = trio.open_memory_channel(0)
+        send_posts, receive_posts = trio.open_memory_channel(self.workers)
+        send_done, receive_done = trio.open_memory_channel(self.batch_size)
 
-            for ind, x in enumerate(self.posts):
-                print(f"{ind}: {x.url}")
+        async with trio.open_nursery() as n:
+            n.start_soon(self.persist, receive_done)
+            async with receive_links, send_posts, receive_posts, send_done:
+                for _ in range(self.workers):
+                    n.start_soon(self.fetch_worker, receive_links.clone(), send_posts.clone())
+                    n.start_soon(self.image_worker, receive_posts.clone(), send_done.clone())
+
+            async with send_links:
+                for record in self.links.values():
+                    await send_links.send(record)
 
-            # Add new bookmarks
-            inter.DBMi.session.add_all(self.posts)
+        if not self.silent:
+            print(f"Finalized all. Got {self.n_posts} new bookmarks.")
 
-            # Add new children
-            inter.DBMi.session.add_all(self.children)
+    async def fetch_pages(self, pages: List[Tuple[int, str]]) -> Dict[int, PageInfo]:
+        """
+        Download and parse the pages of saved posts again, for the archive
 
-            # Commit changes
-            inter.DBMi.session.commit()
+        Args:
+            pages (List[Tuple[int, str]]): The id and url of each post
+
+        Returns:
+            Dict[int, PageInfo]: The parsed page of each post id which could be read
+        """
+        found = {}
+        limiter = trio.CapacityLimiter(self.workers)
+
+        async def fetch(post_id: int, url: str):
+            async with limiter:
+                info = await self.get_page_info(url, None, inter.SESS, post_id, archive=True)
+            if info is not None:
+                found[post_id] = info
+            if self.progress is not None:
+                self.progress()
+
+        async with trio.open_nursery() as n:
+            for post_id, url in pages:
+                n.start_soon(fetch, post_id, url)
+        return found
 
+    def save(self):
+        """
+        Scrape the links and save the posts and children to the database
+        """
+        if len(self.links):
+            print("Saving DB")
+            trio.run(self.get_all)
             print("Saved DB")
 
 
-def update_posts(posts: List[Post]):
+def update_posts(rows: List[Dict[str, Any]], batch_size: int = 500):
     """
-    Update the posts in the database
+    Update columns of saved posts in batches
+
+    Only the columns given in each row are written, so the archived html
+    and everything else stays untouched.
 
     Args:
-        posts (List[Post]): The posts to update
+        rows (List[Dict[str, Any]]): The ``id`` and new column values of each post
+        batch_size (int): The number of rows per executemany
     """
-    if len(posts):
+    if len(rows):
         print("Updating DB")
-        temp = [x.to_dict() for x in posts]
-        print(f'temp: {temp}')
-        inter.DBMi.session.execute(update(Post), temp)
+        # Rows of one executemany have to set the same columns
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for group in groups.values():
+            for x in range(0, len(group), batch_size):
+                inter.DBMi.session.execute(update(Post), group[x:x + batch_size])
+        stats.bump_generation(inter.DBMi.session)
         # Commit changes
         inter.DBMi.session.commit()
         print("Updated DB")
@@ -278,7 +480,9 @@ class BingImgSearch():
 
         err = None
         try:
-            resp: Response = await session.get(url, timeout=10)
+            resp: Response = await inter.SCHED.get(
+                session, url, kind=RequestKind.bing, timeout=10
+            )
             if resp.reason_phrase=='OK': # type: ignore
                 content = resp.content.decode()
                 images = re.findall('murl&quot;:&quot;(.*?)&quot;', content)
@@ -289,18 +493,12 @@ class BingImgSearch():
                     logging.info("Bing found no images for {}".format(url))
             else:
                 print(f"Unable to get url {url}. No response")
-                err = Error(
-                    url=url, type=ErrorType.resp.value, 
-                    time=datetime.now(), description='no response'
-                )
+                err = (ErrorType.resp, 'no response')
         except* Exception as e:
             print("Unable to get url {} due to {}.".format(url, e.__class__))
-            err = Error(
-                url=url, type=ErrorType.bing.value, 
-                time=datetime.now(), description=str(e.__class__)
-            )
+            err = (ErrorType.bing, str(e.__class__))
         if err is not None:
-            inter.DBMi.session.execute(insert(Error), [err.to_dict()])
+            ERRORS.record(url, *err)
 
 
     async def collect(self):    
@@ -308,56 +506,151 @@ class BingImgSearch():
         async with trio.open_nursery() as n:
             for ind, path in enumerate(self.queries):
                 n.start_soon(self.query_img, path, inter.SESS, output, ind)
+        ERRORS.flush(inter.DBMi.session)
+        inter.DBMi.session.commit()
         return output
 
     def get_urls(self):
         return trio.run(self.collect)
 
-async def validate_all(imgs: List[Optional[str]]) -> np.ndarray:
-    image_formats = (
-        "image/png", 
-        "image/jpeg", 
-        "image/jpg", 
-        'image/gif',
-        'image/svg+xml'
-    )
-
-    async def validate(
-        img_url: Optional[str], 
-        session: asks.Session, 
-        valid: np.ndarray,
-        ind: int
-    ):
-        
-        err = None
-        if img_url is not None:
-            try:
-                r: Response = await session.head(img_url, timeout=10)
-                if "content-type" not in r.headers:
-                    # print(f'{img_url} no content')
-                    pass
-                else:
-                    if r.headers["content-type"] not in image_formats:
-                        logging.info(
-                            "Invalid content type {} at {}".format(
-                                    r.headers["content-type"],
-                                    img_url
-                                )
-                            )
-                    else:
-                        valid[ind] = True
-                        logging.info("Successfully got url {}".format(img_url))
-            except* Exception as e:
-                err = Error(
-                    url=img_url, type=ErrorType.img.value, 
-                    time=datetime.now(), description=str(e.__class__)
-                )
-        if err is not None:
-            inter.DBMi.session.execute(insert(Error), [err.to_dict()])
+# Content types accepted as post images
+IMAGE_FORMATS = (
+    "image/png", 
+    "image/jpeg", 
+    "image/jpg", 
+    'image/gif',
+    'image/svg+xml',
+    'image/webp',
+    'image/avif',
+)
 
-    output = np.zeros(len(imgs), dtype=bool)
-    async with trio.open_nursery() as n:
-        for ind, path in enumerate(imgs):
-            n.start_soon(validate, path, inter.SESS, output, ind)
+
+class ImageStatus(Enum):
+    """
+    Outcome of validating a post image
+    """
+    ok = 'ok'
+    invalid = 'invalid'
+    error = 'error'
+
+
+async def check_image(img_url: str, session: asks.Session) -> ImageStatus:
+    """
+    Check that an image url still serves an image
+
+    Args:
+        img_url (str): The url (or data uri) of the image
+        session (asks.Session): The session to send the HEAD request with
+
+    Returns:
+        ImageStatus: ``error`` if the host could not be reached, so it is retried
+    """
+    if img_url.startswith('data:image'):
+        return ImageStatus.ok
+
+    status = ImageStatus.error
+    err = None
+    try:
+        r: Response = await inter.SCHED.head(
+            session, img_url, kind=RequestKind.image, timeout=10
+        )
+        content_type = r.headers.get("content-type", '').split(';')[0].strip().lower()
+        if r.status_code >= 500 or r.status_code == 429:
+            logging.info(f"Unable to check {img_url}, status {r.status_code}")
+        elif content_type not in IMAGE_FORMATS:
+            logging.info(
+                "Invalid content type {} at {}".format(content_type or None, img_url)
+            )
+            status = ImageStatus.invalid
+        else:
+            status = ImageStatus.ok
+    except* Exception as e:
+        err = (ErrorType.img, str(e.__class__))
+    if err is not None:
+        ERRORS.record(img_url, *err)
+    return status
+
+
+def save_image_checks(results: List[Tuple[int, str, ImageStatus]]):
+    """
+    Record a batch of image checks, dropping the invalid images
+
+    Args:
+        results (List[Tuple[int, str, ImageStatus]]): The post id, image and status of each check
+    """
+    if not results:
+        return
+    now = datetime.now()
+    checked = [
+        {'id': post_id, 'img_checked': now, 'img_status': status.value}
+        for post_id, _, status in results if status is not ImageStatus.invalid
+    ]
+    invalid = [
+        {'id': post_id, 'img_checked': now, 'img_status': status.value, 'img': None}
+        for post_id, _, status in results if status is ImageStatus.invalid
+    ]
+    for rows in (checked, invalid):
+        if rows:
+            inter.DBMi.session.execute(update(Post), rows)
+    ERRORS.flush(inter.DBMi.session)
+    stats.bump_generation(inter.DBMi.session)
     inter.DBMi.session.commit()
-    return output
+
+
+async def validate_images(
+    images: List[Tuple[int, str]],
+    workers: int = 32,
+    batch_size: int = 200,
+    progress: Optional[Callable[[], None]] = None,
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> Dict[ImageStatus, int]:
+    """
+    Check post images with bounded concurrency, saving the results in batches
+
+    Args:
+        images (List[Tuple[int, str]]): The post id and image url of each post to check
+        workers (int): The number of concurrent checks
+        batch_size (int): The number of results per database write
+        progress (Optional[Callable[[], None]]): Called after every check
+        cancelled (Optional[Callable[[], bool]]): Stops scheduling checks once it returns True
+
+    Returns:
+        Dict[ImageStatus, int]: The number of images of each status
+    """
+    counts = {x: 0 for x in ImageStatus}
+
+    async def produce(send: trio.MemorySendChannel):
+        async with send:
+            for row in images:
+                if cancelled is not None and cancelled():
+                    logging.info("Image validation cancelled")
+                    break
+                await send.send(row)
+
+    async def check(receive: trio.MemoryReceiveChannel, send: trio.MemorySendChannel):
+        async with receive, send:
+            async for post_id, img in receive:
+                await send.send((post_id, img, await check_image(img, inter.SESS)))
+
+    async def write(receive: trio.MemoryReceiveChannel):
+        results = []
+        async with receive:
+            async for result in receive:
+                counts[result[2]] += 1
+                results.append(result)
+                if progress is not None:
+                    progress()
+                if len(results) >= batch_size:
+                    save_image_checks(results)
+                    results = []
+        save_image_checks(results)
+
+    send_rows, receive_rows = trio.open_memory_channel(0)
+    send_done, receive_done = trio.open_memory_channel(batch_size)
+    async with trio.open_nursery() as n:
+        n.start_soon(produce, send_rows)
+        async with receive_rows, send_done:
+            for _ in range(workers):
+                n.start_soon(check, receive_rows.clone(), send_done.clone())
+        n.start_soon(write, receive_done)
+    return counts
@@ -0,0 +1,78 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from . import interfaces as inter
+import re
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# Titles matter most, then the post text, then the archived article
+RANK = 'bm25(posts_fts, 10.0, 4.0, 1.0)'
+
+
+def index_posts(session: Session, rows: Iterable[Dict[str, Any]]):
+    """
+    Add or replace posts in the full text index
+
+    Args:
+        session (Session): The session writing the posts
+        rows (Iterable[Dict[str, Any]]): The ``id``, ``title``, ``text`` and
+            ``body`` text of each post
+    """
+    rows = list(rows)
+    if rows:
+        session.execute(
+            text(
+                'INSERT OR REPLACE INTO posts_fts (rowid, title, text, body) '
+                'VALUES (:id, :title, :text, :body)'
+            ),
+            rows
+        )
+
+
+def fts_query(query: Optional[str]) -> Optional[str]:
+    """
+    Turn a search box query into an FTS5 query
+
+    Every word must match, and the last one may be a prefix so results
+    update while typing. Quoting the words keeps FTS5 syntax out of user input.
+    """
+    tokens = TOKEN.findall(query or '')
+    if not tokens:
+        return None
+    return ' '.join(f'"{x}"' for x in tokens) + '*'
+
+
+def search(
+    query: Optional[str], page: int = 1, page_size: int = 20
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Full text search over titles, post text and archived articles
+
+    Args:
+        query (Optional[str]): The search box query
+        page (int): The one indexed page of results
+        page_size (int): The number of results per page
+
+    Returns:
+        Tuple[List[Dict[str, Any]], int]: The ranked results of the page and the total
+    """
+    match = fts_query(query)
+    if match is None:
+        return [], 0
+    session = inter.DBMi.reader
+    total = session.execute(
+        text('SELECT count(*) FROM posts_fts WHERE posts_fts MATCH :match'),
+        {'match': match}
+    ).scalar_one()
+    rows = session.execute(
+        text(
+            "SELECT p.id, p.title, p.url, p.date_added, "
+            "snippet(posts_fts, -1, '**', '**', '…', 24) AS snippet "
+            "FROM posts_fts JOIN hn_bookmarks p ON p.id = posts_fts.rowid "
+            f"WHERE posts_fts MATCH :match ORDER BY {RANK} "
+            "LIMIT :limit OFFSET :offset"
+        ),
+        {'match': match, 'limit': page_size, 'offset': (page - 1) * page_size}
+    )
+    return [dict(x._mapping) for x in rows], total
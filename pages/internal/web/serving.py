@@ -0,0 +1,152 @@
+from typing import Any, Callable, Dict, Optional
+from functools import lru_cache
+from dash.fingerprint import check_fingerprint
+from flask import Flask, Response, request
+import logging
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Dash versions the urls of its bundles and of the assets folder
+COMPONENT_SUITES = '/_dash-component-suites/'
+ASSETS = '/assets/'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Callback JSON, layouts and the Dash bundles
+COMPRESSIBLE = {
+    'application/json',
+    'application/javascript',
+    'text/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+    'image/svg+xml',
+}
+# Smaller responses gain nothing from compression
+MIN_SIZE = 1024
+
+ENCODERS: Dict[str, Callable[[bytes], bytes]] = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=6),
+}
+if brotli is not None:
+    # High qualities are too slow to run per request
+    ENCODERS = {'br': lambda data: brotli.compress(data, quality=5), **ENCODERS}
+
+
+@lru_cache(maxsize=64)
+def encode_asset(encoding: str, data: bytes) -> bytes:
+    """Compress a versioned asset once, they never change"""
+    return ENCODERS[encoding](data)
+
+
+def is_versioned(path: str) -> bool:
+    """Whether a url of the Dash bundles or assets changes with its content"""
+    if path.startswith(COMPONENT_SUITES):
+        return check_fingerprint(path)[1]
+    return path.startswith(ASSETS) and 'm' in request.args
+
+
+def cache_headers(response: Response) -> Response:
+    """Let browsers keep versioned Dash bundles and assets for good"""
+    if response.status_code == 200 and is_versioned(request.path):
+        response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def compress(response: Response) -> Response:
+    """
+    Compress a response with brotli or gzip, as accepted by the client
+
+    Args:
+        response (Response): The response of a request
+
+    Returns:
+        Response: The response, compressed if worthwhile
+    """
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in COMPRESSIBLE
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(ENCODERS))
+    data = response.get_data()
+    if encoding is None or len(data) < MIN_SIZE:
+        return response
+
+    if is_versioned(request.path):
+        data = encode_asset(encoding, data)
+    else:
+        data = ENCODERS[encoding](data)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def install(server: Flask):
+    """Add the compression and caching of responses to the Flask server"""
+    server.after_request(cache_headers)
+    server.after_request(compress)
+
+
+def serve(
+    server: Flask,
+    host: str = '127.0.0.1',
+    port: int = 8050,
+    workers: int = 2,
+    threads: int = 8,
+    post_fork: Optional[Callable[[], Any]] = None,
+):
+    """
+    Run the app with a production WSGI server
+
+    Gunicorn runs ``workers`` processes of ``threads`` threads each from the
+    preloaded app, so the database is migrated once before forking. Where
+    gunicorn is unavailable, e.g. on Windows, waitress serves the app with
+    ``workers * threads`` threads in one process.
+
+    Args:
+        server (Flask): The Flask server of the Dash app
+        host (str): The interface to listen on
+        port (int): The port to listen on
+        workers (int): The number of worker processes
+        threads (int): The number of threads per worker
+        post_fork (Optional[Callable]): Called in each worker once forked
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+
+    if BaseApplication is not None:
+        class Application(BaseApplication):
+            def load_config(self):
+                self.cfg.set('bind', f'{host}:{port}')
+                self.cfg.set('workers', workers)
+                self.cfg.set('threads', threads)
+                self.cfg.set('worker_class', 'gthread')
+                self.cfg.set('preload_app', True)
+                if post_fork is not None:
+                    self.cfg.set('post_fork', lambda arbiter, worker: post_fork())
+
+            def load(self):
+                return server
+
+        logging.info(f'Serving with gunicorn, {workers} workers of {threads} threads')
+        Application().run()
+        return
+
+    try:
+        import waitress
+    except ImportError:
+        raise RuntimeError(
+            'Serving needs gunicorn or waitress, install them with the serve extra'
+        )
+    logging.info(f'Serving with waitress, {workers * threads} threads')
+    waitress.serve(server, host=host, port=port, threads=workers * threads)
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+from functools import wraps
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+from .schema import Meta, Post
+from . import interfaces as inter
+import threading
+
+GENERATION = 'generation'
+
+
+def generation() -> int:
+    """
+    Get the write generation of the database
+
+    Every write to the posts bumps it, so anything computed from the posts
+    is valid for as long as the generation it was computed at.
+    """
+    value = inter.DBMi.reader.scalar(select(Meta.value).where(Meta.key == GENERATION))
+    return value or 0
+
+
+def bump_generation(session: Session):
+    """
+    Bump the write generation as part of the pending transaction
+
+    Args:
+        session (Session): The session about to commit the write
+    """
+    stmnt = insert(Meta).values(key=GENERATION, value=1)
+    session.execute(stmnt.on_conflict_do_update(
+        index_elements=[Meta.key], set_={'value': Meta.value + 1}
+    ))
+
+
+class GenerationCache:
+    """
+    Bounded LRU cache of values keyed on (function, arguments, generation).
+
+    Entries of older generations are never hit again and age out of the LRU.
+    """
+    def __init__(self, maxsize: int = 128) -> None:
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: Tuple, func: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+        value = func()
+        with self._lock:
+            self.misses += 1
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+CACHE = GenerationCache()
+
+
+def memoize(func: Callable) -> Callable:
+    """Cache the results of ``func`` in ``CACHE`` until the next write"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__qualname__, args, tuple(sorted(kwargs.items())), generation())
+        return CACHE.get_or_compute(key, lambda: func(*args, **kwargs))
+    return wrapper
+
+
+@memoize
+def post_count() -> int:
+    """Get the number of posts"""
+    return inter.DBMi.reader.query(Post).count()
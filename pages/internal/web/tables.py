@@ -0,0 +1,236 @@
+from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime
+from sqlalchemy import String, cast, func, literal, select, tuple_
+from sqlalchemy.sql import ColumnElement, Select
+from sqlalchemy.types import Date, DateTime, Integer, Float, Boolean
+from . import interfaces as inter
+import logging
+import re
+
+# DataTable filter operators, the word first and its symbolic aliases after
+OPERATORS = [
+    ['ge', '>='],
+    ['le', '<='],
+    ['lt', '<'],
+    ['gt', '>'],
+    ['ne', '!='],
+    ['eq', '='],
+    ['contains'],
+    ['datestartswith'],
+]
+ALIASES = {alias: x[0] for x in OPERATORS for alias in x}
+
+# ``{column} operator value``, with the operator right after the column so
+# a value which happens to contain an operator is never split on it. Longer
+# operators are tried first, so ``>=`` is not read as ``>``, and words must
+# end there, so ``{x} length`` is not ``le``.
+FILTER_PART = re.compile(
+    r'^\s*\{(?P<name>[^}]*)\}\s*(?P<operator>'
+    + '|'.join(
+        re.escape(x) + (r'(?=\s|$)' if x.isalpha() else '')
+        for x in sorted(ALIASES, key=len, reverse=True)
+    )
+    + r')\s*(?P<value>.*?)\s*$',
+    re.DOTALL,
+)
+
+
+def split_filter_part(filter_part: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Split one ``&&`` separated part of a DataTable ``filter_query``
+
+    Args:
+        filter_part (str): e.g. ``{score} >= 100``
+
+    Returns:
+        Tuple[Optional[str], Optional[str], Optional[str]]: The column id, operator and value
+    """
+    match = FILTER_PART.match(filter_part)
+    if match is None:
+        return None, None, None
+
+    value_part = match.group('value')
+    v0 = value_part[0] if value_part else ''
+    if len(value_part) > 1 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+        value = value_part[1: -1].replace('\\' + v0, v0)
+    else:
+        # Left as a string, it is coerced to the column type later
+        value = value_part
+    return match.group('name'), ALIASES[match.group('operator')], value
+
+
+class TableQuery:
+    """
+    Server side paging, sorting and filtering for a DataTable.
+
+    Translates the ``filter_query`` and ``sort_by`` of a DataTable with
+    custom actions into SQL over only the displayed columns.
+
+    Args:
+        columns (Dict[str, ColumnElement]): The SQL expression of each column id
+        where (List[ColumnElement]): Filters always applied to the table
+        key (ColumnElement): A unique column breaking ties, for a stable order
+    """
+    def __init__(
+        self,
+        columns: Dict[str, ColumnElement],
+        where: Optional[List[ColumnElement]] = None,
+        key: Optional[ColumnElement] = None,
+    ) -> None:
+        self.columns = columns
+        self.where = where or []
+        self.key = key
+
+    def _coerce(self, column: ColumnElement, value: Any) -> Any:
+        if isinstance(column.type, (Date, DateTime)):
+            return datetime.fromisoformat(str(value))
+        if isinstance(column.type, (Integer, Float, Boolean)):
+            return float(value)
+        return str(value)
+
+    def filters(self, filter_query: Optional[str]) -> List[ColumnElement]:
+        """
+        Translate a DataTable ``filter_query`` into SQL filters
+
+        Unknown columns and values which do not fit the column type are
+        ignored, like the native DataTable filter does.
+        """
+        output = []
+        for part in (filter_query or '').split(' && '):
+            name, operator, value = split_filter_part(part)
+            if name not in self.columns:
+                continue
+            column = self.columns[name]
+            try:
+                if operator == 'contains':
+                    output.append(cast(column, String).contains(str(value), autoescape=True))
+                elif operator == 'datestartswith':
+                    output.append(cast(column, String).startswith(str(value), autoescape=True))
+                else:
+                    value = self._coerce(column, value)
+                    output.append({
+                        'ge': column >= value,
+                        'le': column <= value,
+                        'lt': column < value,
+                        'gt': column > value,
+                        'ne': column != value,
+                        'eq': column == value,
+                    }[operator])
+            except (ValueError, KeyError):
+                logging.debug(f"Ignoring filter {part!r}")
+        return output
+
+    def order(self, sort_by: Optional[List[Dict[str, str]]]) -> List[ColumnElement]:
+        """Translate a DataTable ``sort_by`` into SQL ordering"""
+        output = []
+        for sort in sort_by or []:
+            if sort['column_id'] in self.columns:
+                column = self.columns[sort['column_id']]
+                output.append(column.desc() if sort['direction'] == 'desc' else column.asc())
+        if self.key is not None:
+            output.append(self.key)
+        return output
+
+    def statement(self, filter_query: Optional[str]) -> Select:
+        labelled = [x.label(name) for name, x in self.columns.items()]
+        return select(*labelled).where(*self.where, *self.filters(filter_query))
+
+    def page(
+        self,
+        page_current: int,
+        page_size: int,
+        sort_by: Optional[List[Dict[str, str]]],
+        filter_query: Optional[str],
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Get one page of rows
+
+        Args:
+            page_current (int): The zero indexed page
+            page_size (int): The number of rows per page
+            sort_by (Optional[List[Dict[str, str]]]): The DataTable sort_by
+            filter_query (Optional[str]): The DataTable filter_query
+
+        Returns:
+            Tuple[List[Dict[str, Any]], int]: The rows of the page and the number of pages
+        """
+        stmnt = self.statement(filter_query)
+        total = inter.DBMi.reader.scalar(
+            select(func.count()).select_from(stmnt.subquery())
+        )
+        rows = inter.DBMi.reader.execute(
+            stmnt.order_by(*self.order(sort_by))
+            .limit(page_size)
+            .offset((page_current or 0) * page_size)
+        )
+        page_count = max(1, -(-total // page_size))
+        return [dict(x._mapping) for x in rows], page_count
+
+
+class KeysetPager:
+    """
+    Stable keyset pagination over an indexed sort key.
+
+    Pages are read with ``WHERE (key, id) < (last key, last id)`` from the
+    cursor of the previous page, so every page costs the same regardless of
+    its depth. Jumping to a page without a known cursor falls back to an
+    ordered offset once, after which its cursor is known.
+
+    Args:
+        key (ColumnElement): The column to sort on
+        tiebreak (ColumnElement): A unique column making the order total
+        descending (bool): Sort in descending order
+    """
+    def __init__(
+        self, key: ColumnElement, tiebreak: ColumnElement, descending: bool = True
+    ) -> None:
+        self.key = key
+        self.tiebreak = tiebreak
+        self.descending = descending
+
+    def cursor(self, row) -> List[Any]:
+        """The json serializable cursor after ``row``"""
+        output = []
+        for column in (self.key, self.tiebreak):
+            value = getattr(row, column.key)
+            output.append(value.isoformat() if isinstance(value, datetime) else value)
+        return output
+
+    def _decode(self, cursor: List[Any]) -> List[Any]:
+        output = []
+        for column, value in zip((self.key, self.tiebreak), cursor):
+            if isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            output.append(value)
+        return output
+
+    def page(
+        self, query, page: int, page_size: int, cursor: Optional[List[Any]] = None
+    ) -> Tuple[List[Any], Optional[List[Any]]]:
+        """
+        Get one page of a query
+
+        Args:
+            query: The ORM query to page through
+            page (int): The one indexed page
+            page_size (int): The number of rows per page
+            cursor (Optional[List[Any]]): The cursor of the end of the previous page
+
+        Returns:
+            Tuple[List[Any], Optional[List[Any]]]: The rows and the cursor of the end of the page
+        """
+        columns = (self.key, self.tiebreak)
+        if self.descending:
+            query = query.order_by(*(x.desc() for x in columns))
+        else:
+            query = query.order_by(*(x.asc() for x in columns))
+
+        if cursor is not None:
+            keys = tuple_(*columns)
+            bound = tuple_(*(literal(x) for x in self._decode(cursor)))
+            query = query.filter(keys < bound if self.descending else keys > bound)
+        elif page > 1:
+            query = query.offset((page - 1) * page_size)
+
+        rows = query.limit(page_size).all()
+        return rows, (self.cursor(rows[-1]) if rows else None)
@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, TextIO
+import threading
+import time
+import sys
+
+
+@dataclass
+class StageStats:
+    """Counters of one stage of the ingestion pipeline"""
+    items: int = 0
+    errors: int = 0
+    bytes: int = 0
+    started: Optional[float] = None
+    last: Optional[float] = None
+
+    def to_dict(self, now: Optional[float] = None) -> Dict[str, Any]:
+        end = (self.last or self.started) if now is None else now
+        elapsed = max(end - self.started, 1e-9) if self.started is not None else 0.
+        return {
+            'items': self.items,
+            'errors': self.errors,
+            'bytes': self.bytes,
+            'seconds': round(elapsed, 3),
+            'items_per_s': round(self.items / elapsed, 2) if elapsed else 0.,
+            'bytes_per_s': round(self.bytes / elapsed, 1) if elapsed else 0.,
+            'error_rate': round(self.errors / self.items, 4) if self.items else 0.,
+        }
+
+
+class Throughput:
+    """
+    Per stage throughput of an ingestion run.
+
+    Every stage is timed from the start of the run until its last
+    ``record``. Timing a stage from its own first item would leave that
+    item's time out, and a stage recorded only once would take no time at
+    all. The stages overlap in a pipeline, so each rate is an average over
+    the run.
+    """
+    def __init__(self) -> None:
+        self.stages: Dict[str, StageStats] = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start(self, stage: str):
+        """List a stage before its first item is done"""
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(started=self.started)
+
+    def record(self, stage: str, n_bytes: int = 0, error: bool = False, items: int = 1):
+        """
+        Count items through a stage
+
+        Args:
+            stage (str): The name of the stage
+            n_bytes (int): The bytes read or written by the items
+            error (bool): Whether the items failed
+            items (int): The number of items
+        """
+        now = time.perf_counter()
+        with self._lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = StageStats(started=self.started)
+            stats.items += items
+            stats.errors += items if error else 0
+            stats.bytes += n_bytes
+            stats.last = now
+
+    def to_dict(self, live: bool = False) -> Dict[str, Any]:
+        """
+        Get a JSON serializable summary of the run
+
+        Args:
+            live (bool): Rate the stages up to now, rather than up to their last item
+        """
+        now = time.perf_counter()
+        with self._lock:
+            return {
+                'seconds': round(now - self.started, 3),
+                'stages': {
+                    name: stats.to_dict(now if live else None)
+                    for name, stats in self.stages.items()
+                },
+            }
+
+    def line(self) -> str:
+        """A one line summary of the stages, for live reporting"""
+        summary = self.to_dict(live=True)
+        parts = [
+            f"{name} {x['items']} ({x['items_per_s']:.1f}/s, "
+            f"{x['bytes_per_s'] / 1024:.0f} KB/s, {x['error_rate']:.1%} err)"
+            for name, x in summary['stages'].items()
+        ]
+        return f"[{summary['seconds']:.0f}s] " + ' | '.join(parts)
+
+
+class LiveReport:
+    """
+    Print the throughput of a run every ``interval`` seconds from a thread
+
+    Args:
+        throughput (Throughput): The run to report on
+        interval (float): Seconds between reports
+        stream (TextIO): Where to print the reports
+    """
+    def __init__(self, throughput: Throughput, interval: float = 2., stream: TextIO = sys.stderr) -> None:
+        self.throughput = throughput
+        self.interval = interval
+        self.stream = stream
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            print(self.throughput.line(), file=self.stream, flush=True)
+
+    def __enter__(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name='live-report', daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,329 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+from appdirs import user_cache_dir
+from pathlib import Path
+from urllib.parse import unquote_to_bytes, urljoin, urlsplit
+from flask import Response, abort, request, send_file
+from requests.adapters import HTTPAdapter
+from sqlalchemy import select
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from .schema import Post
+from . import interfaces as inter
+import ipaddress
+import threading
+import requests
+import hashlib
+import logging
+import socket
+import base64
+import time
+import io
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMB_DIR = Path(user_cache_dir('hn-browser')) / 'thumbs'
+ROUTE = '/thumbs/<int:post_id>.webp'
+
+# Thumbnails are addressed by the source url, so a versioned link never changes
+IMMUTABLE = 'public, max-age=31536000, immutable'
+MAX_REDIRECTS = 3
+
+
+class UnsafeURL(ValueError):
+    """An image url the server must not fetch, e.g. one on the local network"""
+
+
+def digest(src: str) -> str:
+    return hashlib.sha256(src.encode()).hexdigest()
+
+
+def decode_data_uri(src: str) -> Tuple[str, bytes]:
+    """Split a ``data:`` uri into its mimetype and content"""
+    header, data = src[5:].split(',', 1)
+    mimetype = header.split(';')[0] or 'text/plain'
+    if header.endswith(';base64'):
+        return mimetype, base64.b64decode(data)
+    return mimetype, unquote_to_bytes(data)
+
+
+def check_url(src: str):
+    """
+    Make sure an image url points at a public http(s) host
+
+    Every address the host resolves to must be globally routable, so a post
+    cannot make the server fetch from itself or its local network.
+
+    Raises:
+        UnsafeURL: If the url is not http(s) or its host is not public
+    """
+    parts = urlsplit(src)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise UnsafeURL(f'{src[:100]} is not an http(s) url')
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or parts.scheme, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise UnsafeURL(f'{parts.hostname} does not resolve') from e
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if not address.is_global:
+            raise UnsafeURL(f'{parts.hostname} resolves to the non-public {address}')
+
+
+class PublicConnection:
+    """
+    Connection mixin refusing to talk to a non-public peer
+
+    ``check_url`` resolves the host before the request, but the connection
+    resolves it again, and a host may answer differently the second time.
+    The address actually connected to is checked before anything is sent.
+    """
+    def _new_conn(self):
+        sock = super()._new_conn()
+        address = ipaddress.ip_address(sock.getpeername()[0].split('%')[0])
+        if not address.is_global:
+            sock.close()
+            raise UnsafeURL(f'{self.host} connected to the non-public {address}')
+        return sock
+
+
+class PublicHTTPConnection(PublicConnection, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicConnection, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAdapter(HTTPAdapter):
+    """Transport adapter whose connections only reach public addresses"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool,
+        }
+
+
+def public_session() -> requests.Session:
+    """A requests session which can only connect to public addresses"""
+    session = requests.Session()
+    # A proxy would be the peer instead of the image host, so never use one
+    session.trust_env = False
+    adapter = PublicAdapter(max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def thumb_url(post: Post) -> Optional[str]:
+    """
+    The local thumbnail link of a post's image, versioned on the image url
+
+    Without Pillow there are no thumbnails, so this is the original image.
+
+    Args:
+        post (Post): The post to get the thumbnail link of
+
+    Returns:
+        Optional[str]: The link, or None if the post has no image
+    """
+    if not post.img:
+        return None
+    if Image is None:
+        return post.img
+    return f'/thumbs/{post.id}.webp?v={digest(post.img)[:12]}'
+
+
+class ThumbnailCache:
+    """
+    On-disk cache of WebP thumbnails.
+
+    Images are fetched once, shrunk to fit ``size`` and stored under the
+    sha256 of their url. The least recently served thumbnails are evicted
+    once the cache grows past ``max_bytes``. Only public http(s) hosts are
+    fetched, see ``check_url`` and ``PublicConnection``. Images which cannot be fetched or decoded
+    are not tried again for ``retry_failed`` seconds, remembering up to
+    ``max_failed`` of them.
+    """
+    def __init__(
+        self,
+        root: Path = THUMB_DIR,
+        size: Tuple[int, int] = (400, 400),
+        quality: int = 80,
+        max_bytes: int = 256 * 1024 ** 2,
+        max_source_bytes: int = 16 * 1024 ** 2,
+        retry_failed: float = 60 * 60,
+        max_failed: int = 4096,
+    ) -> None:
+        self.root = Path(root)
+        self.size = size
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        self.retry_failed = retry_failed
+        self.max_failed = max_failed
+        self._failed: OrderedDict[str, float] = OrderedDict()
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f'{key}.webp'
+
+    def _download(self, src: str) -> bytes:
+        if src.startswith('data:image'):
+            data = decode_data_uri(src)[1]
+            if len(data) > self.max_source_bytes:
+                raise ValueError(f'data uri is larger than {self.max_source_bytes} bytes')
+            return data
+        # Redirects are followed by hand, so every hop is checked
+        with public_session() as session:
+            for _ in range(MAX_REDIRECTS + 1):
+                check_url(src)
+                with session.get(src, stream=True, timeout=10, allow_redirects=False) as resp:
+                    if resp.is_redirect:
+                        src = urljoin(src, resp.headers['Location'])
+                        continue
+                    resp.raise_for_status()
+                    length = resp.headers.get('Content-Length', '')
+                    if length.isdigit() and int(length) > self.max_source_bytes:
+                        raise ValueError(f'{src} is larger than {self.max_source_bytes} bytes')
+                    content = bytearray()
+                    for chunk in resp.iter_content(64 * 1024):
+                        content += chunk
+                        if len(content) > self.max_source_bytes:
+                            raise ValueError(f'{src} is larger than {self.max_source_bytes} bytes')
+                    return bytes(content)
+            raise ValueError(f'{src} redirected more than {MAX_REDIRECTS} times')
+
+    def _recently_failed(self, key: str) -> bool:
+        with self._lock:
+            failed = self._failed.get(key)
+            if failed is None:
+                return False
+            if time.time() - failed < self.retry_failed:
+                return True
+            del self._failed[key]
+            return False
+
+    def _fail(self, key: str):
+        with self._lock:
+            self._failed[key] = time.time()
+            self._failed.move_to_end(key)
+            while len(self._failed) > self.max_failed:
+                self._failed.popitem(last=False)
+
+    def _render(self, raw: bytes) -> bytes:
+        with Image.open(io.BytesIO(raw)) as img:
+            img.thumbnail(self.size)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+            output = io.BytesIO()
+            img.save(output, 'WEBP', quality=self.quality, method=4)
+        return output.getvalue()
+
+    def get(self, src: str) -> Optional[Path]:
+        """
+        Get the thumbnail of an image, making it on the first request
+
+        Args:
+            src (str): The url or data uri of the image
+
+        Returns:
+            Optional[Path]: The thumbnail file, or None if it could not be made
+        """
+        if Image is None:
+            return None
+        key = digest(src)
+        path = self._path(key)
+        try:
+            # Modification time drives the LRU eviction
+            os.utime(path)
+            return path
+        except OSError:
+            pass
+
+        if self._recently_failed(key):
+            return None
+        try:
+            data = self._render(self._download(src))
+        except Exception as e:
+            logging.info(f'Unable to make a thumbnail of {src[:100]}: {e.__class__.__name__}')
+            self._fail(key)
+            return None
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so concurrent requests never serve partial files
+        tmp = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp, path)
+        self._grow(len(data))
+        return path
+
+    def _entries(self):
+        for path in self.root.glob('*/*.webp'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+    def _grow(self, n: int):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(x[1] for x in self._entries())
+            else:
+                self._size += n
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently served thumbnails until the cache is 90% full
+        """
+        entries = sorted(self._entries())
+        size = sum(x[1] for x in entries)
+        target = int(self.max_bytes * .9)
+        removed = 0
+        for _, n, path in entries:
+            if size <= target:
+                break
+            path.unlink(missing_ok=True)
+            size -= n
+            removed += 1
+        self._size = size
+        logging.info(f"Evicted {removed} thumbnails")
+
+
+THUMBS = ThumbnailCache()
+
+
+def serve(post_id: int) -> Response:
+    """Flask view serving the thumbnail of a post, 404 when there is none"""
+    src = inter.DBMi.reader.scalar(select(Post.img).where(Post.id == post_id))
+    if not src:
+        abort(404)
+
+    path = THUMBS.get(src)
+    if path is None:
+        abort(404)
+
+    resp = send_file(path, mimetype='image/webp')
+    if request.args.get('v') == digest(src)[:12]:
+        resp.headers['Cache-Control'] = IMMUTABLE
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
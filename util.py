@@ -1,7 +1,10 @@
 import logging
 from enum import Enum
 import argparse
-from typing import Optional, Any
+import importlib.abc
+import time
+import sys
+from typing import Optional, Any, Dict, List, Tuple
 
 class LogLevel(Enum):
     """
@@ -52,4 +55,105 @@ class EnumAction(argparse.Action):
                 f"You need to pass a value after {option_string}!")
         else:
             # A pretty invalid choice message will be generated by argparse
-            raise argparse.ArgumentTypeError()
\ No newline at end of file
+            raise argparse.ArgumentTypeError()
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    """
+    Time the imports made while running, like ``python -X importtime``.
+
+    Installed first on ``sys.meta_path``, it wraps the loader of each module
+    found by the other finders and records the time spent loading the module
+    itself and including the modules it imports.
+    """
+
+    def __init__(self) -> None:
+        self.times: Dict[str, Tuple[float, float]] = {}
+        self.total = 0.
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+        self._stack: List[float] = []
+
+    def start(self):
+        self.started = time.perf_counter()
+        sys.meta_path.insert(0, self)
+
+    def stop(self):
+        self.stopped = time.perf_counter()
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader, name, self)
+            return spec
+        return None
+
+    def _enter(self):
+        self._stack.append(0.)
+
+    def _exit(self, name: str, elapsed: float):
+        children = self._stack.pop()
+        self.times[name] = (elapsed - children, elapsed)
+        if self._stack:
+            self._stack[-1] += elapsed
+        else:
+            self.total += elapsed
+
+    def report(self, limit: int = 20) -> str:
+        """
+        Summarize the startup and its slowest imports
+
+        Args:
+            limit (int): The number of imports to list
+
+        Returns:
+            str: The report, slowest imports first
+        """
+        end = self.stopped if self.stopped is not None else time.perf_counter()
+        lines = [
+            f'Startup took {end - self.started:.3f}s, '
+            f'{len(self.times)} modules imported in {self.total:.3f}s',
+            f'{"self [ms]":>10} | {"cumulative":>10} | module',
+        ]
+        slowest = sorted(self.times.items(), key=lambda x: x[1][1], reverse=True)
+        for name, (own, cumulative) in slowest[:limit]:
+            lines.append(f'{own * 1000:>10.1f} | {cumulative * 1000:>10.1f} | {name}')
+        return '\n'.join(lines)
+
+
+class _TimedLoader:
+    """Loader wrapper recording the load time of a module in an ``ImportTimer``"""
+
+    def __init__(self, loader: Any, name: str, timer: ImportTimer) -> None:
+        self.loader = loader
+        self.name = name
+        self.timer = timer
+        self.created = 0.
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.loader, attr)
+
+    def create_module(self, spec):
+        create = getattr(self.loader, 'create_module', None)
+        if create is None:
+            return None
+        # Extension modules are loaded here rather than in exec_module
+        start = time.perf_counter()
+        module = create(spec)
+        self.created = time.perf_counter() - start
+        return module
+
+    def exec_module(self, module):
+        self.timer._enter()
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.timer._exit(self.name, self.created + time.perf_counter() - start)